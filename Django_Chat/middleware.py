@@ -1,20 +1,19 @@
 from urllib.parse import parse_qs
 from django.contrib.auth.models import AnonymousUser
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
 from jwt import InvalidTokenError
+from user_api.identity import aget_token_user
 
 User = get_user_model()
 
-# Asynchronous function to retrieve user from a validated token
-@database_sync_to_async
-def get_user(validated_token):
-    jwt_auth = JWTAuthentication()
+# Asynchronous function to retrieve user from a validated token, through the identity cache
+async def get_user(validated_token):
     try:
-        return jwt_auth.get_user(validated_token)
-    except Exception:
+        return await aget_token_user(validated_token)
+    except (AuthenticationFailed, InvalidToken):
         return AnonymousUser()
 
 # Custom middleware to authenticate WebSocket connections using JWT
@@ -27,7 +26,7 @@ class JWTAuthMiddleware(BaseMiddleware):
             try:
                 validated_token = JWTAuthentication().get_validated_token(token)
                 scope["user"] = await get_user(validated_token)
-            except InvalidTokenError:
+            except (InvalidToken, InvalidTokenError):
                 scope["user"] = AnonymousUser()
         else:
             scope["user"] = AnonymousUser()
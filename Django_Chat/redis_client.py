@@ -0,0 +1,20 @@
+import asyncio
+import weakref
+import redis.asyncio as aioredis
+from django.conf import settings
+
+# One connection pool per event loop, asyncio connections can't be shared across loops
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_redis():
+    """
+    Returns an asyncio redis client for the running event loop.
+    It points at the same database as the django-redis cache so sync and async code see the same keys.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = aioredis.ConnectionPool.from_url(settings.CACHES["default"]["LOCATION"])
+        _pools[loop] = pool
+    return aioredis.Redis(connection_pool=pool)
@@ -0,0 +1,15 @@
+from django.db.models import Manager
+from rest_framework import serializers
+
+
+# List serializer that loads what its rows need for the whole page before rendering them
+class PrefetchListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, Manager) else data
+        iterable = list(iterable)
+        self.prefetch(iterable)
+        return super().to_representation(iterable)
+
+    def prefetch(self, objects):
+        """Called with the page's objects before any row is rendered."""
+        raise NotImplementedError
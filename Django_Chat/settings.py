@@ -68,7 +68,7 @@ AUTHENTICATION_BACKENDS = [
 # Django REST framework configuration
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "user_api.authentication.CachedJWTAuthentication",
     ),
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
@@ -121,6 +121,56 @@ CACHES = {
     }
 }
 
+# Presence: sockets refresh their heartbeat every interval and count as gone after the ttl
+PRESENCE_HEARTBEAT_INTERVAL = 30
+PRESENCE_TTL = 90
+# Last seen times are written to the database by the flush_presence command, in batches of this many users
+PRESENCE_FLUSH_BATCH_SIZE = 1000
+# Seconds between flushes when flush_presence runs with --loop
+PRESENCE_FLUSH_INTERVAL = 30
+
+# Message notifications are created and pushed in batches collected over this window (seconds)
+NOTIFICATION_BATCH_WINDOW = 0.05
+NOTIFICATION_BATCH_SIZE = 200
+
+# The prune_notifications command deletes read notifications older than NOTIFICATION_RETENTION_DAYS,
+# NOTIFICATION_PRUNE_BATCH_SIZE rows per statement, every NOTIFICATION_PRUNE_INTERVAL seconds with --loop
+NOTIFICATION_RETENTION_DAYS = 30
+NOTIFICATION_PRUNE_BATCH_SIZE = 5000
+NOTIFICATION_PRUNE_INTERVAL = 3600
+
+# Read receipts sent over a chat socket within this window (seconds) are written as one watermark update
+READ_RECEIPT_WINDOW = 0.5
+
+# Messages sent over chat sockets within this window (seconds) are inserted together
+MESSAGE_BATCH_WINDOW = 0.005
+MESSAGE_BATCH_SIZE = 100
+
+# Typing indicators: a user's state in a room is refreshed at most every TYPING_THROTTLE seconds, the state
+# expires after TYPING_TIMEOUT and each room gets at most one typing update per broadcast interval
+TYPING_THROTTLE = 2
+TYPING_TIMEOUT = 5
+TYPING_BROADCAST_INTERVAL = 0.5
+
+# Cached first page of each user's chat list, kept at most this long (seconds) between changes
+SIDEBAR_SNAPSHOT_TTL = 600
+# Snapshot hits and misses counted in a process before they're added to the shared counters
+SIDEBAR_STATS_FLUSH_EVERY = 1000
+
+# First pages of user directory searches are cached this long (seconds), 0 disables the cache
+USER_SEARCH_CACHE_TTL = 30
+
+# Authenticated user identities are cached in redis for IDENTITY_CACHE_TTL seconds and in every
+# process for IDENTITY_LOCAL_TTL seconds, changes apply at once since every lookup checks the version
+IDENTITY_CACHE_TTL = 300
+IDENTITY_LOCAL_TTL = 60
+IDENTITY_LOCAL_SIZE = 10000
+# Identity cache lookups and loads counted in a process before they're added to the shared counters
+IDENTITY_STATS_FLUSH_EVERY = 1000
+
+# Cached room member sets are dropped on membership changes and expire after this long (seconds)
+MEMBERSHIP_CACHE_TTL = 3600
+
 
 # CORS settings for cross-origin requests
 CORS_ALLOW_CREDENTIALS = True
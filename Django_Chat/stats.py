@@ -0,0 +1,46 @@
+import threading
+from collections import Counter
+from django_redis import get_redis_connection
+
+
+class BatchedCounters:
+    """
+    Counters of a hot path, kept in the process and added to a redis hash in
+    batches. Callers hand in a pipeline they send anyway, so counting costs
+    no round trip and requests don't all write the same key.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def flush_into(self, pipe, every):
+        """Adds the counts to the pipeline once at least `every` have built up."""
+        with self._lock:
+            if sum(self._counts.values()) < every:
+                return
+            counts = dict(self._counts)
+            self._counts.clear()
+        for name, count in counts.items():
+            pipe.hincrby(self.key, name, count)
+
+    def totals(self):
+        # Flushed counts of all processes
+        return {
+            name.decode(): int(count)
+            for name, count in get_redis_connection("default").hgetall(self.key).items()
+        }
+
+    def reset(self):
+        # Counts other processes haven't flushed yet still arrive later
+        self.clear()
+        get_redis_connection("default").delete(self.key)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
@@ -0,0 +1,115 @@
+import os
+import fakeredis
+import redis.asyncio as aioredis
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django_redis import get_redis_connection
+from chat_room import membership, sidebar_cache
+from Django_Chat import redis_client
+from user_api import identity
+
+# Tests run against an in-memory redis server shared by the sync and asyncio
+# clients, and an in-memory channel layer, so they need no redis at all.
+
+FAKE_REDIS_SERVER = fakeredis.FakeServer()
+
+FAKE_REDIS_SETTINGS = {
+    "CACHES": {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            # django-redis keeps pools per url for the whole process, this one is only used here
+            "LOCATION": "redis://fake-redis:6379/0",
+            "OPTIONS": {
+                "CLIENT_CLASS": "django_redis.client.DefaultClient",
+                "CONNECTION_POOL_KWARGS": {
+                    "connection_class": fakeredis.FakeConnection,
+                    "server": FAKE_REDIS_SERVER,
+                },
+            },
+        }
+    },
+    "CHANNEL_LAYERS": {
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    },
+}
+
+
+def _fake_async_pool(cls, url, **kwargs):
+    return cls(connection_class=fakeredis.aioredis.FakeConnection, server=FAKE_REDIS_SERVER)
+
+
+class FakeRedisMixin:
+    """
+    Points the django-redis cache, get_async_redis and the channel layer at
+    in-memory stand-ins. Every test starts with empty redis and channel layer.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        settings_override = override_settings(**FAKE_REDIS_SETTINGS)
+        settings_override.enable()
+        cls.addClassCleanup(settings_override.disable)
+        pool_patch = mock.patch.object(aioredis.ConnectionPool, "from_url", classmethod(_fake_async_pool))
+        pool_patch.start()
+        cls.addClassCleanup(pool_patch.stop)
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        get_redis_connection("default").flushall()
+        async_to_sync(get_channel_layer().flush)()
+        # Process local state that would outlive the flushed redis
+        redis_client._pools.clear()
+        identity._local.clear()
+        identity._stats.clear()
+        sidebar_cache._stats.clear()
+
+
+def make_user(username):
+    # No password, hashing one per user would dominate the test time
+    return get_user_model().objects.create_user(username=username, email=f"{username}@example.com")
+
+
+def cache_members(room):
+    # Test transactions never commit and loads inside one aren't cached, so cache
+    # the room's members the way a load after the commit would
+    membership.prime_members(room.id, room.participants.values_list('id', flat=True))
+
+
+# Benchmarks live in the benchmarks.py module of each app. The test runner only
+# discovers test*.py, so they run when named: python manage.py test chat_room.benchmarks
+# BENCHMARK_SCALE scales their fixtures, 0.01 runs a 1M row benchmark on 10k rows.
+
+def benchmark_size(size):
+    return max(1, int(size * float(os.environ.get("BENCHMARK_SCALE", "1"))))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(name, **measurements):
+    # One line per measurement, readable in the runner's output
+    print(f"\n{name}: " + ", ".join(
+        f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}" for key, value in measurements.items()
+    ))
+
+
+def count_async_pipelines():
+    """
+    Patches the asyncio redis pipeline to count round trips and the commands they
+    carried. Returns the counters and the patch, to be used as a context manager.
+    """
+    counters = {"round_trips": 0, "commands": 0}
+    execute = aioredis.client.Pipeline.execute
+
+    async def counted(pipe, *args, **kwargs):
+        counters["round_trips"] += 1
+        counters["commands"] += len(pipe.command_stack)
+        return await execute(pipe, *args, **kwargs)
+
+    return counters, mock.patch.object(aioredis.client.Pipeline, "execute", counted)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatRoom, Message, MessageReadStatus, Notification
+from .models import ChatRoom, Message, ReadWatermark, Notification
 
 # Admin interface for ChatRoom model
 @admin.register(ChatRoom)
@@ -18,14 +18,14 @@ class MessageAdmin(admin.ModelAdmin):
     search_fields = ('content',)
     date_hierarchy = 'timestamp'
 
-# Admin interface for MessageReadStatus model
-@admin.register(MessageReadStatus)
-class MessageReadStatusAdmin(admin.ModelAdmin):
-    list_display = ('id', 'message', 'user', 'timestamp')
-    list_filter = ('timestamp',)
+# Admin interface for ReadWatermark model
+@admin.register(ReadWatermark)
+class ReadWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('id', 'room', 'user', 'last_read_id', 'updated_at')
+    list_filter = ('updated_at',)
 
 # Admin interface for Notification model
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'message', 'timestamp', 'is_read')
+    list_display = ('id', 'user', 'room', 'message', 'count', 'timestamp', 'is_read')
     list_filter = ('timestamp', 'is_read')
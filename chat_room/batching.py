@@ -0,0 +1,20 @@
+import asyncio
+
+
+async def next_batch(queue, window, max_size):
+    """
+    Waits for the next item on an asyncio queue, then keeps collecting items
+    for up to `window` seconds or until `max_size` items are gathered.
+    """
+    batch = [await queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + window
+    while len(batch) < max_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
@@ -0,0 +1,537 @@
+import asyncio
+import random
+import time
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from Django_Chat.testing import FakeRedisMixin, benchmark_size, cache_members, make_user, percentile, report
+from . import dispatcher, membership, retention, sidebar_cache
+from .models import ChatRoom, Message, Notification, ReadWatermark
+from .pagination import ChatCursorPagination
+from .tests import client_for, connect, make_room
+
+
+# Latency of sending a message to a 50 member group, with notifications created
+# in the request like before the dispatcher, and handed to the dispatcher
+class MessageSendLatencyBenchmark(FakeRedisMixin, TestCase):
+    MEMBERS = 50
+    MESSAGES = 200
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(self.MEMBERS)]
+        self.room = make_room(self.members, is_group=True, room_name="everyone")
+        self.client = client_for(self.members[0])
+
+    def send_latencies(self):
+        latencies = []
+        for i in range(benchmark_size(self.MESSAGES)):
+            start = time.perf_counter()
+            # The commit callbacks run as part of the request, like after a real commit
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    f"/api/chatrooms/{self.room.id}/messages/", {"content": f"message {i}"}, format="json"
+                )
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(response.status_code, 201)
+        return latencies
+
+    def test_send_latency(self):
+        channel_layer = get_channel_layer()
+
+        def dispatch_inline(message_ids):
+            # What the request used to do itself: the notifications, then a bridged group send per recipient
+            for group, event in dispatcher.process_new_messages(message_ids):
+                async_to_sync(channel_layer.group_send)(group, event)
+
+        with mock.patch.object(dispatcher.notification_dispatcher, "dispatch", dispatch_inline):
+            before = self.send_latencies()
+
+        # The background worker's database work isn't part of the request, and its
+        # thread can't see this test's uncommitted rows, so it's left out
+        with mock.patch.object(dispatcher, "process_new_messages", return_value=[]):
+            after = self.send_latencies()
+            # Let the last batch drain before the patch is undone
+            time.sleep(settings.NOTIFICATION_BATCH_WINDOW * 4)
+
+        for name, latencies in (("inline", before), ("dispatcher", after)):
+            report(
+                f"message send latency, {name}",
+                messages=len(latencies),
+                p50_ms=percentile(latencies, 0.5) * 1000,
+                p99_ms=percentile(latencies, 0.99) * 1000,
+            )
+        self.assertLess(percentile(after, 0.5), percentile(before, 0.5))
+
+
+# Table size and write rate of read receipts in a full group, every member
+# reading every message as it arrives
+class ReadWatermarkBenchmark(FakeRedisMixin, TestCase):
+    MEMBERS = 50
+    MESSAGES = 1000
+
+    def test_table_size_and_write_rate(self):
+        members = [make_user(f"member{i}") for i in range(self.MEMBERS)]
+        room = make_room(members, is_group=True, room_name="everyone")
+        messages = Message.objects.bulk_create([
+            Message(room=room, sender=members[0], content=f"message {i}")
+            for i in range(benchmark_size(self.MESSAGES))
+        ])
+
+        start = time.perf_counter()
+        for message in messages:
+            for reader in members[1:]:
+                ReadWatermark.advance(room.id, reader.id, message.id)
+        elapsed = time.perf_counter() - start
+
+        receipts = len(messages) * (len(members) - 1)
+        rows = ReadWatermark.objects.filter(room=room).count()
+        report(
+            "read watermarks",
+            receipts=receipts,
+            receipts_per_second=receipts / elapsed,
+            watermark_rows=rows,
+            # One row per message and reader
+            read_status_rows=receipts,
+        )
+        self.assertEqual(rows, len(members) - 1)
+
+
+# Channel layer messages per second of typing indicators in a busy 50 member
+# room, where every typist starts or stops typing 10 times a second
+@override_settings(TYPING_THROTTLE=0, TYPING_BROADCAST_INTERVAL=0.5)
+class TypingLoadBenchmark(FakeRedisMixin, TestCase):
+    MEMBERS = 50
+    TYPISTS = 10
+    FRAME_INTERVAL = 0.1
+    DURATION = 5
+
+    def test_channel_layer_messages_per_second(self):
+        members = [make_user(f"member{i}") for i in range(self.MEMBERS)]
+        room = make_room(members, is_group=True, room_name="everyone")
+        channel_layer = get_channel_layer()
+
+        async def type_for_a_while(group_send):
+            sockets = await asyncio.gather(*(connect(f"/ws/chat/{room.id}/", member) for member in members))
+            loop = asyncio.get_running_loop()
+            frames, start = 0, loop.time()
+            while loop.time() - start < self.DURATION:
+                frame = {"type": "typing" if frames // self.TYPISTS % 2 == 0 else "stop_typing"}
+                for socket in sockets[:self.TYPISTS]:
+                    await socket.send_json_to(frame)
+                frames += self.TYPISTS
+                await asyncio.sleep(self.FRAME_INTERVAL)
+            elapsed = loop.time() - start
+            # The broadcast scheduled last goes out one interval later
+            await asyncio.sleep(2 * settings.TYPING_BROADCAST_INTERVAL)
+            broadcasts = sum(1 for call in group_send.call_args_list if call.args[1]["type"] == "typing.update")
+            await asyncio.gather(*(socket.disconnect() for socket in sockets))
+            return frames, broadcasts, elapsed
+
+        with mock.patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            frames, broadcasts, elapsed = async_to_sync(type_for_a_while)(group_send)
+
+        report(
+            "typing indicators",
+            frames_per_second=frames / elapsed,
+            broadcasts_per_second=broadcasts / elapsed,
+            # Every broadcast reaches every member's socket
+            deliveries_per_second=broadcasts * len(members) / elapsed,
+        )
+        # At most one broadcast per interval, however many frames arrive
+        self.assertLessEqual(broadcasts, elapsed / settings.TYPING_BROADCAST_INTERVAL + 2)
+        self.assertGreater(broadcasts, 0)
+
+
+# Messages per second sent over chat sockets, through the batching writer, and over REST
+class MessageThroughputBenchmark(FakeRedisMixin, TestCase):
+    MESSAGES = 500
+    SOCKETS = 10
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(self.SOCKETS)]
+        self.room = make_room(self.members, is_group=True, room_name="everyone")
+        cache_members(self.room)
+
+    def rest_rate(self, count):
+        client = client_for(self.members[0])
+        start = time.perf_counter()
+        for i in range(count):
+            response = client.post(f"/api/chatrooms/{self.room.id}/messages/", {"content": f"rest {i}"}, format="json")
+            self.assertEqual(response.status_code, 201)
+        return count / (time.perf_counter() - start)
+
+    async def socket_rate(self, count):
+        sockets = await asyncio.gather(*(connect(f"/ws/chat/{self.room.id}/", member) for member in self.members))
+        start = time.perf_counter()
+        for i in range(count):
+            await sockets[i % len(sockets)].send_json_to(
+                {"type": "send_message", "client_id": str(i), "content": f"socket {i}"}
+            )
+
+        async def acks(index, socket):
+            # Every socket also receives the room's new messages, only its own acks are counted
+            expected = len(range(index, count, len(sockets)))
+            received = 0
+            while received < expected:
+                frame = await socket.receive_json_from(timeout=30)
+                if frame["type"] == "message_ack":
+                    received += 1
+                else:
+                    self.assertEqual(frame["type"], "new_message")
+
+        await asyncio.gather(*(acks(index, socket) for index, socket in enumerate(sockets)))
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*(socket.disconnect() for socket in sockets))
+        return count / elapsed
+
+    def test_messages_per_second(self):
+        count = benchmark_size(self.MESSAGES)
+        rest = self.rest_rate(count)
+        socket = async_to_sync(self.socket_rate)(count)
+        report("message throughput", messages=count, rest_per_second=rest, socket_per_second=socket)
+        self.assertGreater(socket, rest)
+
+
+# Chat list latency of a user in 500 rooms, rendered from the database (cold)
+# and served from the user's snapshot (warm)
+class SidebarSnapshotBenchmark(FakeRedisMixin, TestCase):
+    ROOMS = 500
+    REQUESTS = 50
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        for i in range(benchmark_size(self.ROOMS)):
+            friend = make_user(f"friend{i}")
+            room = make_room([self.user, friend])
+            Message.objects.create(room=room, sender=friend, content=f"hi {i}")
+        self.client = client_for(self.user)
+
+    def list_latencies(self, cold):
+        latencies = []
+        for _ in range(self.REQUESTS):
+            if cold:
+                sidebar_cache.invalidate_snapshots([self.user.id])
+            start = time.perf_counter()
+            response = self.client.get("/api/chatrooms/")
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(response.status_code, 200)
+        return latencies
+
+    def test_cold_and_warm_list_latency(self):
+        cold = self.list_latencies(cold=True)
+        sidebar_cache.reset_snapshot_stats()
+        with override_settings(SIDEBAR_STATS_FLUSH_EVERY=1):
+            warm = self.list_latencies(cold=False)
+
+        for name, latencies in (("cold", cold), ("warm", warm)):
+            report(
+                f"chat list latency, {name}",
+                rooms=benchmark_size(self.ROOMS),
+                p50_ms=percentile(latencies, 0.5) * 1000,
+                p99_ms=percentile(latencies, 0.99) * 1000,
+            )
+        # The first warm request finds the snapshot the last cold one stored
+        self.assertEqual(sidebar_cache.snapshot_stats()["hit_rate"], 1.0)
+        self.assertLess(percentile(warm, 0.5), percentile(cold, 0.5))
+
+
+# Chat list page latency from the first to the last page of a user in 100k rooms,
+# against an OFFSET query as deep as the last page
+class ChatListKeysetBenchmark(FakeRedisMixin, TestCase):
+    ROOMS = 100000
+    BATCH = 5000
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        now = timezone.now()
+        rooms = benchmark_size(self.ROOMS)
+        through = ChatRoom.participants.through
+        for first in range(0, rooms, self.BATCH):
+            # bulk_create skips ChatRoom.save and the m2m signals, neither matters for the list
+            created = ChatRoom.objects.bulk_create([
+                # Pairs of rooms share their activity time, the id breaks the tie
+                ChatRoom(creator=self.user, is_group=True, room_name=f"room {i}",
+                         last_activity_at=now - timedelta(seconds=i // 2))
+                for i in range(first, min(first + self.BATCH, rooms))
+            ])
+            through.objects.bulk_create([through(chatroom=room, user=self.user) for room in created])
+        self.client = client_for(self.user)
+
+    def test_page_latency_by_depth(self):
+        latencies = []
+        url = "/api/chatrooms/"
+        # The first page would come from the snapshot after the first request
+        sidebar_cache.invalidate_snapshots([self.user.id])
+        while url:
+            start = time.perf_counter()
+            response = self.client.get(url)
+            latencies.append(time.perf_counter() - start)
+            url = response.data["next"]
+
+        page_size = ChatCursorPagination.page_size
+        queryset = ChatRoom.objects.filter(participants=self.user).order_by('-last_activity_at', '-id')
+        start = time.perf_counter()
+        list(queryset[(len(latencies) - 1) * page_size:len(latencies) * page_size])
+        offset_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        list(queryset[:page_size])
+        first_seconds = time.perf_counter() - start
+
+        tenth = max(1, len(latencies) // 10)
+        shallow, deep = latencies[:tenth], latencies[-tenth:]
+        report(
+            "chat list pages",
+            rooms=benchmark_size(self.ROOMS),
+            pages=len(latencies),
+            first_tenth_p50_ms=percentile(shallow, 0.5) * 1000,
+            last_tenth_p50_ms=percentile(deep, 0.5) * 1000,
+            offset_last_page_query_ms=offset_seconds * 1000,
+            offset_first_page_query_ms=first_seconds * 1000,
+        )
+        self.assertEqual(len(latencies), -(-benchmark_size(self.ROOMS) // page_size))
+        # A keyset page costs the same at any depth
+        self.assertLess(percentile(deep, 0.5), 5 * percentile(shallow, 0.5))
+
+
+# Search latency over a million messages in 1000 rooms, through the search index
+# and through the icontains scan it replaced
+class MessageSearchBenchmark(FakeRedisMixin, TestCase):
+    MESSAGES = 1000000
+    ROOMS = 1000
+    MEMBER_OF = 100
+    BATCH = 10000
+    REQUESTS = 20
+    # Zipf like vocabulary: common words are in many messages, "zebra" in few
+    WORDS = ["hello", "meeting", "lunch", "today", "project", "release", "budget", "zebra"]
+    WEIGHTS = [400, 200, 100, 50, 25, 12, 6, 1]
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        other = make_user("other")
+        randomizer = random.Random(0)
+        self.rooms = ChatRoom.objects.bulk_create([
+            ChatRoom(creator=other, is_group=True, room_name=f"room {i}") for i in range(self.ROOMS)
+        ])
+        through = ChatRoom.participants.through
+        through.objects.bulk_create(
+            [through(chatroom=room, user=other) for room in self.rooms]
+            + [through(chatroom=room, user=self.user) for room in self.rooms[:self.MEMBER_OF]]
+        )
+        total = benchmark_size(self.MESSAGES)
+        for first in range(0, total, self.BATCH):
+            Message.objects.bulk_create([
+                Message(room=self.rooms[i % self.ROOMS], sender=other,
+                        content=" ".join(randomizer.choices(self.WORDS, self.WEIGHTS, k=8)))
+                for i in range(first, min(first + self.BATCH, total))
+            ])
+        cache_members(self.rooms[0])
+        self.client = client_for(self.user)
+
+    def latencies(self, url, params):
+        latencies = []
+        for _ in range(self.REQUESTS):
+            start = time.perf_counter()
+            response = self.client.get(url, params)
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(response.status_code, 200)
+        return latencies
+
+    def test_search_latency(self):
+        room = self.rooms[0]
+        for word in ("meeting", "zebra"):
+            indexed = self.latencies(f"/api/chatrooms/{room.id}/messages/search/", {"q": word})
+            everywhere = self.latencies("/api/chatrooms/search/", {"q": word})
+            start = time.perf_counter()
+            scanned = Message.objects.filter(room=room, content__icontains=word).count()
+            scan_seconds = time.perf_counter() - start
+            report(
+                f"message search, {word}",
+                messages=benchmark_size(self.MESSAGES),
+                room_p50_ms=percentile(indexed, 0.5) * 1000,
+                room_p99_ms=percentile(indexed, 0.99) * 1000,
+                all_rooms_p50_ms=percentile(everywhere, 0.5) * 1000,
+                all_rooms_p99_ms=percentile(everywhere, 0.99) * 1000,
+                icontains_count_ms=scan_seconds * 1000,
+                room_hits=scanned,
+            )
+
+
+# Chat socket connects per second in a 50 member group, with membership checked
+# in the database like before the member sets, and against the cached set
+class ChatConnectBenchmark(FakeRedisMixin, TestCase):
+    MEMBERS = 50
+    CONNECTS = 1000
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(self.MEMBERS)]
+        self.room = make_room(self.members, is_group=True, room_name="everyone")
+
+    async def connect_all(self):
+        elapsed, connects = 0, benchmark_size(self.CONNECTS)
+        for i in range(connects):
+            start = time.perf_counter()
+            socket = await connect(f"/ws/chat/{self.room.id}/", self.members[i % len(self.members)])
+            elapsed += time.perf_counter() - start
+            await socket.disconnect()
+        return connects / elapsed
+
+    def measure(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            rate = async_to_sync(self.connect_all)()
+        return rate, len(queries.captured_queries)
+
+    def test_connects_per_second(self):
+        async def member_from_database(room_id, user_id):
+            # The room, then its participants, each on a thread hop
+            room = await database_sync_to_async(ChatRoom.objects.get)(id=room_id)
+            return await database_sync_to_async(room.participants.filter(id=user_id).exists)()
+
+        with mock.patch.object(membership, "ais_member", member_from_database):
+            database = self.measure()
+        cache_members(self.room)
+        cached = self.measure()
+
+        for name, (rate, queries) in (("database", database), ("member set", cached)):
+            report(f"chat socket connects, {name}", connects=benchmark_size(self.CONNECTS),
+                   per_second=rate, queries=queries)
+        self.assertEqual(database[1], 2 * benchmark_size(self.CONNECTS))
+        self.assertEqual(cached[1], 0)
+        self.assertGreater(cached[0], database[0])
+
+
+# Delete throughput of pruning 10M notifications, four in five of them read and
+# past the retention period, and the table size once a day of expired rows
+# is pruned on top of the retained ones
+class NotificationPruneBenchmark(FakeRedisMixin, TestCase):
+    ROWS = 10000000
+    USERS = 1000
+    EXPIRED = 0.8
+    BATCH = 10000
+    DAY = 0.01
+
+    def setUp(self):
+        super().setUp()
+        self.users = [make_user(f"user{i}") for i in range(self.USERS)]
+
+    def insert(self, count, expired):
+        first_id = None
+        for first in range(0, count, self.BATCH):
+            created = Notification.objects.bulk_create([
+                Notification(user=self.users[i % len(self.users)], is_read=expired, notification_type='mention')
+                for i in range(first, min(first + self.BATCH, count))
+            ])
+            first_id = first_id or created[0].id
+        if expired and first_id:
+            # timestamp is set on insert, age the rows past the retention period
+            Notification.objects.filter(id__gte=first_id).update(
+                timestamp=timezone.now() - timedelta(days=settings.NOTIFICATION_RETENTION_DAYS + 1)
+            )
+
+    def prune(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            start = time.perf_counter()
+            deleted = retention.prune_notifications()
+            elapsed = time.perf_counter() - start
+        deletes = [float(query["time"]) for query in queries.captured_queries
+                   if query["sql"].upper().startswith("DELETE")]
+        return deleted, elapsed, deletes
+
+    def test_delete_throughput_and_steady_state(self):
+        total = benchmark_size(self.ROWS)
+        expired = int(total * self.EXPIRED)
+        self.insert(total - expired, expired=False)
+        self.insert(expired, expired=True)
+
+        deleted, elapsed, deletes = self.prune()
+        retained = Notification.objects.count()
+        report(
+            "notification prune",
+            rows=total,
+            deleted=deleted,
+            rows_per_second=deleted / elapsed,
+            batches=len(deletes),
+            longest_delete_ms=max(deletes) * 1000,
+            rows_left=retained,
+        )
+
+        # A day later: another day of notifications has expired and is pruned
+        day = int(total * self.DAY)
+        self.insert(day, expired=True)
+        deleted_daily, elapsed_daily, _ = self.prune()
+        report(
+            "notification prune, steady state",
+            deleted=deleted_daily,
+            seconds=elapsed_daily,
+            rows_left=Notification.objects.count(),
+        )
+        self.assertEqual(deleted, expired)
+        self.assertEqual(retained, total - expired)
+        self.assertEqual(deleted_daily, day)
+        self.assertEqual(Notification.objects.count(), retained)
+        self.assertEqual(len(deletes), -(-expired // settings.NOTIFICATION_PRUNE_BATCH_SIZE))
+
+
+# Notification rows and statements written for a busy 50 member group, one row
+# per recipient and message like before collapsing, and one per user and room
+# per unread stretch, everyone reading the room every 100 messages
+class NotificationVolumeBenchmark(FakeRedisMixin, TestCase):
+    MEMBERS = 50
+    MESSAGES = 2000
+    READ_EVERY = 100
+
+    def setUp(self):
+        super().setUp()
+        members = [make_user(f"member{i}") for i in range(self.MEMBERS)]
+        room = make_room(members, is_group=True, room_name="everyone")
+        self.room_members = {room.id: [member.id for member in members]}
+        self.messages = Message.objects.bulk_create([
+            Message(room=room, sender=members[i % len(members)], content=f"message {i}")
+            for i in range(benchmark_size(self.MESSAGES))
+        ])
+        # Loaded once, the dispatcher selects the senders with the messages
+        for message in self.messages:
+            message.sender
+
+    def write(self, notify):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            start = time.perf_counter()
+            for i, message in enumerate(self.messages, 1):
+                # Every message in its own dispatcher batch, the worst case
+                notify(message)
+                if i % self.READ_EVERY == 0:
+                    Notification.objects.filter(is_read=False).update(is_read=True)
+            elapsed = time.perf_counter() - start
+        rows = Notification.objects.count()
+        Notification.objects.all().delete()
+        return rows, len(queries.captured_queries), elapsed
+
+    def test_notification_write_volume(self):
+        def one_per_message(message):
+            # What create_notifications did before, without a room so the unread constraint doesn't apply
+            Notification.objects.bulk_create([
+                Notification(user_id=user_id, message=message, notification_type="new_message")
+                for user_id in self.room_members[message.room_id] if user_id != message.sender_id
+            ])
+
+        before = self.write(one_per_message)
+        after = self.write(lambda message: dispatcher.create_notifications([message], self.room_members))
+
+        for name, (rows, statements, elapsed) in (("per message", before), ("collapsed", after)):
+            report(f"notification writes, {name}", messages=len(self.messages), rows=rows,
+                   statements=statements, seconds=elapsed)
+        stretches = -(-len(self.messages) // self.READ_EVERY)
+        self.assertEqual(before[0], len(self.messages) * (self.MEMBERS - 1))
+        self.assertLessEqual(after[0], stretches * self.MEMBERS)
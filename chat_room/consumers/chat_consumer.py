@@ -1,48 +1,63 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+import asyncio
 import json
+import time
 from channels.exceptions import DenyConnection
-from ..models import ChatRoom, User
 from channels.db import database_sync_to_async
-from ..models import Message, MessageReadStatus
-from django_redis import get_redis_connection
+from ..models import Message, ReadWatermark
+from django.db.models import Max
 from django.utils import timezone
-from django.utils import timezone
-from asgiref.sync import sync_to_async
+from django.conf import settings
+from ..sidebar import sidebar_group_name
+from ..sidebar_cache import invalidate_snapshots
+from .. import typing_indicator
+from ..message_writer import get_message_writer
+from .. import membership
+from user_api import presence
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         self.room_id = int(self.scope['url_route']['kwargs']['chatroom_id'])
         self.room_group_name = f'chat_{self.room_id}'
         self.user = self.scope['user']
+        self.pending_read_id = None
+        self.read_flush_task = None
+        self.is_typing = False
+        self.typing_refreshed_at = 0
+        self.typing_timeout_task = None
+        self.typing_broadcast_task = None
+        self.typing_broadcast_token = None
         
         # Deny connection if the user is not authenticated
         if not self.user or not self.user.is_authenticated:
             raise DenyConnection("User not authenticated")
         
-        # Check if the user is a participant in the room
-        try:
-            room = await database_sync_to_async(ChatRoom.objects.get)(id=self.room_id)
-            is_participant = await database_sync_to_async(room.participants.filter(id=self.user.id).exists)()
-            if not is_participant:
-                raise DenyConnection("User is not in the chatroom")
-        except ChatRoom.DoesNotExist:
-            raise DenyConnection("Room does not exist")
+        # Check if the user is a participant in the room, a missing room has no members
+        if not await membership.ais_member(self.room_id, self.user.id):
+            raise DenyConnection("User is not in the chatroom")
         
         # Add the user to the room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.set_online_status(True)
         await self.accept()
         
     async def disconnect(self, close_code):
+        # Write out receipts still waiting for the debounce window
+        if getattr(self, 'read_flush_task', None):
+            self.read_flush_task.cancel()
+            self.read_flush_task = None
+            await self.flush_read_receipts()
+
+        if getattr(self, 'is_typing', False):
+            await self.stop_typing()
+
+        # A pending typing broadcast goes out now instead of from a task outliving the socket
+        if getattr(self, 'typing_broadcast_task', None):
+            self.typing_broadcast_task.cancel()
+            self.typing_broadcast_task = None
+            await self.broadcast_typing()
+
         # Remove the user from the room group
-        await self.set_online_status(False)
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-        
-    @database_sync_to_async
-    def set_online_status(self, status: bool):
-        user = User.objects.get(id=self.user.id)
-        user.online_status = status
-        user.save()
           
     async def receive(self, text_data):
         data = json.loads(text_data)
@@ -50,36 +65,19 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         # Handle 'typing' and 'stop_typing' events
         if event_type == "typing":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'show_typing',
-                    'username': self.user.username
-                }
-            )
+            await self.start_typing()
         elif event_type == 'stop_typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'hide_typing',
-                    'username': self.user.username
-                }
-            )
-        elif event_type =='read_message':
+            await self.stop_typing()
+        elif event_type in ('read_up_to', 'read_message'):
             await self.handle_read_message(data)
+        elif event_type == 'send_message':
+            await self.handle_send_message(data)
 
-    # Send 'typing' event to the group
-    async def show_typing(self, event):
-        await self.send_json({
-            'type': 'typing',
-            'username': event['username']
-        })
-        
-    # Send 'stop_typing' event to the group
-    async def hide_typing(self, event):
+    # Send the users currently typing in the room
+    async def typing_update(self, event):
         await self.send_json({
-            'type': 'stop_typing',
-            'username': event['username']
+            'type': 'typing_update',
+            'users': event['users']
         })
     
     # Send a new message to the group
@@ -100,35 +98,164 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
 
 
+    async def handle_send_message(self, data):
+        # Messages are persisted by the worker's batching writer, client_id is echoed back for acknowledgement
+        client_id = data.get("client_id")
+        content = data.get("content")
+        if not isinstance(content, str) or not content.strip():
+            await self.send_json({
+                'type': 'message_error',
+                'client_id': client_id,
+                'error': 'Message content is required'
+            })
+            return
+
+        # Membership is checked on every send, a participant removed from the room keeps an open socket
+        if not await membership.ais_member(self.room_id, self.user.id):
+            await self.send_json({
+                'type': 'message_error',
+                'client_id': client_id,
+                'error': 'User is not in the chatroom'
+            })
+            await self.close()
+            return
+
+        try:
+            message = await get_message_writer().submit(self.room_id, self.user, content)
+        except Exception:
+            await self.send_json({
+                'type': 'message_error',
+                'client_id': client_id,
+                'error': 'Message could not be sent'
+            })
+            return
+
+        await self.send_json({
+            'type': 'message_ack',
+            'client_id': client_id,
+            'message': message
+        })
+
+    async def start_typing(self):
+        # Repeated 'typing' frames within TYPING_THROTTLE are dropped, this socket's own without a round trip
+        now = time.monotonic()
+        if self.is_typing and now - self.typing_refreshed_at < settings.TYPING_THROTTLE:
+            return
+        self.is_typing = True
+        self.typing_refreshed_at = now
+
+        # Stop typing server side when the client goes quiet
+        if self.typing_timeout_task:
+            self.typing_timeout_task.cancel()
+        self.typing_timeout_task = asyncio.create_task(self.expire_typing())
+
+        # Another socket of the user refreshed the state within the throttle
+        if not await typing_indicator.claim_typing_refresh(self.room_id, self.user.username):
+            return
+        changed = await typing_indicator.set_typing(self.room_id, self.user.username, True)
+        if changed:
+            await self.schedule_typing_broadcast()
+
+    async def expire_typing(self):
+        await asyncio.sleep(settings.TYPING_TIMEOUT)
+        self.typing_timeout_task = None
+        # Another socket's cleanup may already have dropped the expired entry, the room still needs the update
+        await self.stop_typing(always_broadcast=True)
+
+    async def stop_typing(self, always_broadcast=False):
+        # Duplicate 'stop_typing' frames are ignored
+        if not self.is_typing:
+            return
+        self.is_typing = False
+        if self.typing_timeout_task:
+            self.typing_timeout_task.cancel()
+            self.typing_timeout_task = None
+
+        changed = await typing_indicator.set_typing(self.room_id, self.user.username, False)
+        if changed or always_broadcast:
+            await self.schedule_typing_broadcast()
+
+    async def schedule_typing_broadcast(self):
+        # Changes are batched into one room event per TYPING_BROADCAST_INTERVAL
+        token = await typing_indicator.claim_broadcast(self.room_id)
+        if token:
+            self.typing_broadcast_token = token
+            self.typing_broadcast_task = asyncio.create_task(self.broadcast_typing_later())
+
+    async def broadcast_typing_later(self):
+        await asyncio.sleep(settings.TYPING_BROADCAST_INTERVAL)
+        self.typing_broadcast_task = None
+        await self.broadcast_typing()
+
+    async def broadcast_typing(self):
+        token, self.typing_broadcast_token = self.typing_broadcast_token, None
+        await typing_indicator.release_broadcast(self.room_id, token)
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'typing.update',
+                'users': await typing_indicator.typing_users(self.room_id)
+            }
+        )
+
     async def handle_read_message(self, data):
-        message_id = data.get("message_id")
+        # Receipts are coalesced: only the highest id matters for the watermark, so
+        # everything reported within READ_RECEIPT_WINDOW becomes one write and one event
+        message_id = self.parse_read_receipt(data)
+        if message_id is None:
+            return
+
+        self.pending_read_id = max(self.pending_read_id or 0, message_id)
+        if self.read_flush_task is None:
+            self.read_flush_task = asyncio.create_task(self.flush_read_receipts_later())
+
+    @staticmethod
+    def parse_read_receipt(data):
+        # Accepts a single message_id, a list of message_ids or a {"from", "to"} range
         try:
-            message = await database_sync_to_async(Message.objects.select_related('room').get)(id=message_id)
-            
-            if message.sender_id == self.user.id:
-                return
-            
-            # Create read status
-            read_status, created = await database_sync_to_async(MessageReadStatus.objects.get_or_create)(
-                message=message, user=self.user
+            if 'message_ids' in data:
+                return max(int(message_id) for message_id in data['message_ids'])
+            if 'range' in data:
+                return int(data['range']['to'])
+            return int(data.get('message_id'))
+        except (TypeError, ValueError, KeyError):
+            return None
+
+    async def flush_read_receipts_later(self):
+        await asyncio.sleep(settings.READ_RECEIPT_WINDOW)
+        self.read_flush_task = None
+        await self.flush_read_receipts()
+
+    async def flush_read_receipts(self):
+        message_id, self.pending_read_id = self.pending_read_id, None
+        if message_id is None:
+            return
+
+        read_up_to = await self.advance_watermark(message_id)
+        if read_up_to:
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    "type": "message.read",
+                    "message_id": read_up_to,
+                    "reader": {
+                        "id": self.user.id,
+                        "username": self.user.username,
+                    },
+                    "read_at": timezone.now().isoformat()
+                }
             )
 
-            if created:
-                await self.channel_layer.group_send(
-                    f"chat_{message.room.id}",
-                    {
-                        "type": "message.read",
-                        "message_id": message.id,
-                        "reader": {
-                            "id": self.user.id,
-                            "username": self.user.username,
-                        },
-                        "read_at": read_status.timestamp.isoformat()
-                    }
-                )
-
-        except Message.DoesNotExist:
-            pass
+    @database_sync_to_async
+    def advance_watermark(self, message_id):
+        # Clamp to the newest message of this room at or below the reported id
+        last_read_id = Message.objects.filter(
+            room_id=self.room_id, id__lte=message_id
+        ).aggregate(last_read_id=Max('id'))['last_read_id']
+        if last_read_id and ReadWatermark.advance(self.room_id, self.user.id, last_read_id):
+            invalidate_snapshots([self.user.id])
+            return last_read_id
+        return None
 
 #consumer for sidebar chat where it displays group names and stufff
 
@@ -138,31 +265,33 @@ class SideBarConsumer(AsyncJsonWebsocketConsumer):
         if not user or not user.is_authenticated:
             raise DenyConnection("User is not authenticated")
         
-        await self.channel_layer.group_add("sidebar", self.channel_name)
+        # Join the user's personal sidebar group
+        await self.channel_layer.group_add(sidebar_group_name(user.id), self.channel_name)
         await self.set_user_online(user.id)
         await self.accept()
         
     async def disconnect(self, code):
         user = self.scope['user']
         if user and user.is_authenticated:
+            if hasattr(self, 'heartbeat_task'):
+                self.heartbeat_task.cancel()
             await self.set_user_offline(user.id)
-        await self.channel_layer.group_discard("sidebar", self.channel_name)
+            await self.channel_layer.group_discard(sidebar_group_name(user.id), self.channel_name)
         
     async def group_update(self, event):
         await self.send_json(event["data"])
         
     
     async def set_user_online(self, user_id):
-        conn = get_redis_connection("default")
-        conn.set(f"user:{user_id}:online", "1")
+        # Register this connection and keep its presence alive while the socket is open
+        await presence.heartbeat(user_id, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.send_heartbeats(user_id))
+
+    async def send_heartbeats(self, user_id):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            await presence.heartbeat(user_id, self.channel_name)
 
     async def set_user_offline(self, user_id):
-        conn = get_redis_connection("default")
-        current_time=timezone.now().isoformat()
-        await sync_to_async(conn.set)(f"user:{user_id}:online", "0")
-        await sync_to_async(conn.set)(f"user:{user_id}:last_seen", current_time)
-        await self.update_last_seen(user_id, current_time)
-        
-    @database_sync_to_async
-    def update_last_seen(self, user_id, timestamp):
-        User.objects.filter(id=user_id).update(last_seen=timestamp)
\ No newline at end of file
+        # Recorded in redis only, flush_presence writes it to the users table
+        await presence.disconnect(user_id, self.channel_name, timezone.now())
\ No newline at end of file
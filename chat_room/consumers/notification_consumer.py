@@ -95,15 +95,16 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
         notifications = Notification.objects.filter(
             user=self.user,
             is_read=False
-        ).order_by('-timestamp')[:20]
+        ).select_related('message__sender').order_by('-timestamp')[:20]
         
         return [
             {
                 'id': notification.id,
                 'message_id': notification.message.id if notification.message else None,
                 'sender': notification.message.sender.username if notification.message else None,
-                'room_id': notification.message.room.id if notification.message else None,
+                'room_id': notification.room_id or (notification.message.room_id if notification.message else None),
                 'content': notification.message.content[:50] + '...' if notification.message and len(notification.message.content) > 50 else notification.message.content if notification.message else None,
+                'count': notification.count,
                 'timestamp': notification.timestamp.isoformat(),
                 'is_read': notification.is_read,
                 'notification_type': notification.notification_type
@@ -113,13 +114,11 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
     
     @database_sync_to_async
     def mark_notification_read(self, notification_id):
-        try:
-            notification = Notification.objects.get(id=notification_id, user=self.user)
-            notification.is_read = True
-            notification.save()
-            return True
-        except Notification.DoesNotExist:
-            return False
+        # Only the flag is written, like the REST mark_read, so counts a dispatcher adds
+        # meanwhile aren't overwritten. False if the notification is missing or already read.
+        return bool(Notification.objects.filter(
+            id=notification_id, user=self.user, is_read=False
+        ).update(is_read=True))
     
     @database_sync_to_async
     def mark_all_notifications_read(self):
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import threading
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .batching import next_batch
+from .models import ChatRoom, Message, Notification
+from .sidebar_cache import apply_new_messages
+
+# logger for error tracking
+logger = logging.getLogger(__name__)
+
+
+def process_new_messages(message_ids):
+    """
+    Loads a batch of new messages with their rooms' members once, updates the
+    members' sidebar snapshots and creates the notifications.
+    Returns the (group, event) pairs to push over the channel layer.
+    """
+    messages = list(Message.objects.filter(id__in=message_ids).select_related('sender'))
+    memberships = ChatRoom.participants.through.objects.filter(
+        chatroom_id__in={message.room_id for message in messages}
+    ).values_list('chatroom_id', 'user_id')
+
+    room_members = {}
+    for room_id, user_id in memberships:
+        room_members.setdefault(room_id, []).append(user_id)
+
+    try:
+        apply_new_messages(messages, room_members)
+    except Exception as e:
+        # A failed snapshot update must not cost the notifications
+        logger.error(f"Error updating sidebar snapshots for messages {message_ids}: {e}")
+    return create_notifications(messages, room_members)
+
+
+def create_notifications(messages, room_members):
+    """
+    Counts a batch of new messages into the recipients' unread new_message
+    notification of each room and returns the (group, event) pairs to push
+    over the channel layer. A recipient without one gets it created, so a
+    room costs one notification row per unread stretch instead of one per message.
+    """
+    # (user, room) -> number of new messages and the latest of them
+    counts = {}
+    for message in sorted(messages, key=lambda message: message.id):
+        for user_id in room_members.get(message.room_id, []):
+            if user_id != message.sender_id:
+                count, _ = counts.get((user_id, message.room_id), (0, None))
+                counts[(user_id, message.room_id)] = (count + 1, message)
+    if not counts:
+        return []
+
+    # Recipients with the same count and latest message in a room are updated together
+    updates = {}
+    for (user_id, room_id), (count, message) in counts.items():
+        updates.setdefault((room_id, count, message.id), []).append(user_id)
+
+    unread = Notification.objects.filter(is_read=False, notification_type="new_message")
+    now = timezone.now()
+    with transaction.atomic():
+        notifications = {}
+        pending = set(counts)
+        while pending:
+            # Missing rows start at zero, conflicts mean another worker or an earlier batch created them
+            Notification.objects.bulk_create([
+                Notification(user_id=user_id, room_id=room_id, message=counts[(user_id, room_id)][1],
+                             count=0, notification_type="new_message")
+                for user_id, room_id in pending
+            ], ignore_conflicts=True)
+            # Locked until the counts are added, so a row can't be marked read in between.
+            # A row marked read since the insert has to be created again.
+            for notification in unread.select_for_update().filter(
+                room_id__in={room_id for _, room_id in pending},
+                user_id__in={user_id for user_id, _ in pending},
+            ).order_by('id'):
+                key = (notification.user_id, notification.room_id)
+                if key in pending:
+                    notifications[key] = notification
+                    pending.discard(key)
+
+        for (room_id, count, message_id), user_ids in updates.items():
+            unread.filter(room_id=room_id, user_id__in=user_ids).update(
+                count=F('count') + count, message_id=message_id, timestamp=now
+            )
+
+    events = []
+    for key, notification in notifications.items():
+        count, message = counts[key]
+        # The row as the update left it
+        notification.count += count
+        notification.timestamp = now
+        content = message.content or ""
+        events.append((
+            f"notification_{notification.user_id}",
+            {
+                "type": "send_notification",
+                "message": {
+                    "id": notification.id,
+                    "message_id": message.id,
+                    "sender": message.sender.username,
+                    "room_id": message.room_id,
+                    "content": content[:50] + '...' if len(content) > 50 else content,
+                    "count": notification.count,
+                    "timestamp": notification.timestamp.isoformat() if notification.timestamp else None,
+                    "is_read": False,
+                    "notification_type": notification.notification_type
+                }
+            }
+        ))
+    return events
+
+
+class NotificationDispatcher:
+    """
+    Creates and pushes message notifications, and updates sidebar snapshots, on a
+    background event loop so the request that sent the message doesn't wait for them. Messages arriving within
+    NOTIFICATION_BATCH_WINDOW are handled together and their group sends run concurrently.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._queue = None
+
+    def dispatch(self, message_ids):
+        # Safe to call from any thread, the worker is started on first use
+        with self._lock:
+            if self._loop is None:
+                self._start()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, list(message_ids))
+
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        self._queue = asyncio.Queue()
+        threading.Thread(target=loop.run_forever, name="notification-dispatcher", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._run(), loop)
+        self._loop = loop
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        while True:
+            batch = await next_batch(
+                self._queue, settings.NOTIFICATION_BATCH_WINDOW, settings.NOTIFICATION_BATCH_SIZE
+            )
+            message_ids = [message_id for message_ids in batch for message_id in message_ids]
+            try:
+                # Not thread sensitive: the shared sync thread belongs to the server's own loop
+                events = await database_sync_to_async(process_new_messages, thread_sensitive=False)(message_ids)
+                await asyncio.gather(*(
+                    channel_layer.group_send(group, event) for group, event in events
+                ))
+            except Exception as e:
+                # Log any errors and keep the worker alive
+                logger.error(f"Error dispatching notifications for messages {message_ids}: {e}")
+
+
+notification_dispatcher = NotificationDispatcher()
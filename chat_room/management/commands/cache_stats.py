@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from chat_room.sidebar_cache import reset_snapshot_stats, snapshot_stats
+from user_api.identity import identity_stats, reset_identity_stats
+
+
+def rate(value):
+    return f"{value:.1%}" if value is not None else "n/a"
+
+
+class Command(BaseCommand):
+    help = "Reports the hit rates of the chat list snapshots and the identity cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help="Reset the counters after reporting them.",
+        )
+
+    def handle(self, *args, **options):
+        # Processes add their counts in batches, the latest of each process aren't in yet
+        stats = snapshot_stats()
+        self.stdout.write(
+            f"Chat list snapshots: {stats['hits']} hits, {stats['misses']} misses, hit rate {rate(stats['hit_rate'])}"
+        )
+        stats = identity_stats()
+        self.stdout.write(
+            f"Identity cache: {stats['lookups']} lookups, {stats['db_loads']} database loads, "
+            f"{stats['saved_queries']} queries saved, {rate(stats['saved_per_request'])} of requests"
+        )
+        if options['reset']:
+            reset_snapshot_stats()
+            reset_identity_stats()
@@ -0,0 +1,43 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat_room.retention import prune_notifications
+
+
+class Command(BaseCommand):
+    help = "Deletes read notifications older than the retention period, optionally archiving them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.NOTIFICATION_RETENTION_DAYS,
+            help="Read notifications older than this many days are pruned.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.NOTIFICATION_PRUNE_BATCH_SIZE,
+            help="Rows deleted per statement.",
+        )
+        parser.add_argument(
+            '--archive', metavar='PATH',
+            help="Append the pruned rows to this gzipped NDJSON file before deleting them.",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help="Seconds to sleep between batches.",
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help="Keep pruning every NOTIFICATION_PRUNE_INTERVAL seconds instead of once.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = prune_notifications(
+                retention_days=options['days'],
+                batch_size=options['batch_size'],
+                archive=options['archive'],
+                pause=options['pause'],
+            )
+            self.stdout.write(f"Pruned {deleted} notifications")
+            if not options['loop']:
+                return
+            time.sleep(settings.NOTIFICATION_PRUNE_INTERVAL)
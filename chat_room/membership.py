@@ -0,0 +1,90 @@
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+from Django_Chat.redis_client import get_async_redis
+from .models import ChatRoom
+
+# Room members are cached in redis as one set per room, loaded from the
+# database on first use. Every set holds the sentinel member 0 so a loaded
+# empty room can be told from one that isn't cached. Membership changes bump
+# the room's version and drop the set; a load watches the version, so a set
+# read from the database before a change commits is never cached.
+
+LOADED = 0
+
+
+def members_key(room_id):
+    return f"room:{room_id}:members"
+
+
+def members_version_key(room_id):
+    return f"room:{room_id}:members_version"
+
+
+def _store_members(pipe, room_id, member_ids):
+    pipe.delete(members_key(room_id))
+    pipe.sadd(members_key(room_id), LOADED, *member_ids)
+    pipe.expire(members_key(room_id), settings.MEMBERSHIP_CACHE_TTL)
+
+
+def load_members(room_id):
+    """Reads the members of a room from the database and caches them."""
+    redis = get_redis_connection("default")
+    with redis.pipeline() as pipe:
+        pipe.watch(members_version_key(room_id))
+        member_ids = set(ChatRoom.participants.through.objects.filter(
+            chatroom_id=room_id
+        ).values_list('user_id', flat=True))
+        # Inside a transaction the rows may still be rolled back, so they're not cached
+        if connection.in_atomic_block:
+            return member_ids
+        try:
+            pipe.multi()
+            _store_members(pipe, room_id, member_ids)
+            pipe.execute()
+        except WatchError:
+            # Changed while loading, the next lookup loads again
+            pass
+    return member_ids
+
+
+def prime_members(room_id, member_ids):
+    """Caches members known to the caller, without the version check of a load."""
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    _store_members(pipe, room_id, member_ids)
+    pipe.execute()
+
+
+def is_member(room_id, user_id):
+    """Whether the user belongs to the room, one redis round trip once the room is cached."""
+    is_in, loaded = get_redis_connection("default").smismember(members_key(room_id), [user_id, LOADED])
+    if loaded:
+        return bool(is_in)
+    return user_id in load_members(room_id)
+
+
+async def ais_member(room_id, user_id):
+    is_in, loaded = await get_async_redis().smismember(members_key(room_id), [user_id, LOADED])
+    if loaded:
+        return bool(is_in)
+    return user_id in await database_sync_to_async(load_members)(room_id)
+
+
+def member_ids(room_id):
+    """Ids of all members of the room."""
+    members = {int(member) for member in get_redis_connection("default").smembers(members_key(room_id))}
+    if LOADED in members:
+        members.discard(LOADED)
+        return members
+    return load_members(room_id)
+
+
+def invalidate_members(room_ids):
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for room_id in set(room_ids):
+        pipe.incr(members_version_key(room_id))
+        pipe.expire(members_version_key(room_id), settings.MEMBERSHIP_CACHE_TTL)
+        pipe.delete(members_key(room_id))
+    pipe.execute()
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import weakref
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from .batching import next_batch
+from .dispatcher import notification_dispatcher
+from .models import ChatRoom, Message
+from .serializers import MessageSerializer
+from .sidebar import last_message_update, send_sidebar_update
+
+# logger for error tracking
+logger = logging.getLogger(__name__)
+
+# One writer per event loop, its queue and task belong to that loop
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter()
+    return writer
+
+
+def persist_messages(messages):
+    """
+    Inserts a batch of messages with one statement and returns their serialized
+    payloads plus the participants of every room touched by the batch.
+    """
+    with transaction.atomic():
+        messages = Message.objects.bulk_create(messages)
+
+        # bulk_create skips Message.save and post_save, so the room pointers and notifications are handled here
+        latest_in_room = {message.room_id: message for message in messages}
+        for message in latest_in_room.values():
+            ChatRoom.update_last_message(message)
+        message_ids = [message.id for message in messages]
+        transaction.on_commit(lambda: notification_dispatcher.dispatch(message_ids))
+
+    room_members = {}
+    memberships = ChatRoom.participants.through.objects.filter(
+        chatroom_id__in=latest_in_room
+    ).values_list('chatroom_id', 'user_id')
+    for room_id, user_id in memberships:
+        room_members.setdefault(room_id, []).append(user_id)
+
+    return MessageSerializer(messages, many=True).data, room_members
+
+
+class MessageWriter:
+    """
+    Persists messages sent over chat sockets. Messages arriving on this worker within
+    MESSAGE_BATCH_WINDOW, across all rooms, are inserted together and then broadcast.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, room_id, sender, content):
+        """Queues a message and returns its serialized payload once it's committed."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((Message(room_id=room_id, sender=sender, content=content), future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = await next_batch(self._queue, settings.MESSAGE_BATCH_WINDOW, settings.MESSAGE_BATCH_SIZE)
+            messages = [message for message, _ in batch]
+            try:
+                payloads, room_members = await database_sync_to_async(persist_messages)(messages)
+            except Exception as e:
+                # One bad row, like a room deleted meanwhile, fails the whole insert:
+                # retry one by one so only its sender gets the error
+                logger.error(f"Error saving a batch of {len(messages)} messages, retrying one by one: {e}")
+                batch, payloads, room_members = await self._persist_each(batch)
+
+            for (_, future), payload in zip(batch, payloads):
+                if not future.done():
+                    future.set_result(payload)
+
+            try:
+                await self._broadcast([message for message, _ in batch], payloads, room_members)
+            except Exception as e:
+                logger.error(f"Error broadcasting a batch of {len(messages)} messages: {e}")
+
+    async def _persist_each(self, batch):
+        # Returns the saved part of the batch with its payloads and room members, failed messages get their error
+        saved, payloads, room_members = [], [], {}
+        for message, future in batch:
+            try:
+                (payload,), members = await database_sync_to_async(persist_messages)([message])
+            except Exception as e:
+                logger.error(f"Error saving a message to room {message.room_id}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            saved.append((message, future))
+            payloads.append(payload)
+            room_members.update(members)
+        return saved, payloads, room_members
+
+    async def _broadcast(self, messages, payloads, room_members):
+        rooms = {}
+        for message, payload in zip(messages, payloads):
+            rooms.setdefault(message.room_id, []).append((message, payload))
+        await asyncio.gather(*(
+            self._broadcast_room(room_id, room_messages, room_members.get(room_id, []))
+            for room_id, room_messages in rooms.items()
+        ))
+
+    async def _broadcast_room(self, room_id, room_messages, member_ids):
+        # Messages of one room go out in order, sidebars only need the newest one
+        channel_layer = get_channel_layer()
+        for _, payload in room_messages:
+            await channel_layer.group_send(f"chat_{room_id}", {"type": "chat.message", "message": payload})
+        latest_message, _ = room_messages[-1]
+        await send_sidebar_update(member_ids, last_message_update(latest_message))
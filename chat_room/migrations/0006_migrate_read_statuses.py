@@ -0,0 +1,34 @@
+from django.db import migrations
+from django.db.models import Max
+
+
+def read_statuses_to_watermarks(apps, schema_editor):
+    # Each participant's watermark starts at the newest message they had marked as read
+    MessageReadStatus = apps.get_model('chat_room', 'MessageReadStatus')
+    ReadWatermark = apps.get_model('chat_room', 'ReadWatermark')
+
+    latest_reads = MessageReadStatus.objects.values('message__room_id', 'user_id').annotate(
+        last_read_id=Max('message_id')
+    ).order_by()
+    ReadWatermark.objects.bulk_create(
+        (
+            ReadWatermark(room_id=row['message__room_id'], user_id=row['user_id'], last_read_id=row['last_read_id'])
+            for row in latest_reads.iterator()
+        ),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0005_readwatermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(read_statuses_to_watermarks, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='MessageReadStatus',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-16 20:44
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_last_activity_at(apps, schema_editor):
+    # Rooms were active last when their last message was sent, or when they were created
+    ChatRoom = apps.get_model('chat_room', 'ChatRoom')
+    Message = apps.get_model('chat_room', 'Message')
+    last_message_time = Message.objects.filter(pk=OuterRef('last_message_id')).values('timestamp')[:1]
+    ChatRoom.objects.update(last_activity_at=Coalesce(Subquery(last_message_time), F('created_at')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0006_migrate_read_statuses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_activity_at, migrations.RunPython.noop),
+    ]
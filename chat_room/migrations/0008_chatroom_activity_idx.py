@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-16 20:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0007_chatroom_last_activity_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['last_activity_at', 'id'], name='chatroom_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,80 @@
+from django.db import migrations
+
+# The search index lives outside the ORM: a generated tsvector column with a
+# GIN index on PostgreSQL, an external content FTS5 table kept in sync by
+# triggers on SQLite. Other databases get nothing and search falls back to
+# icontains, see chat_room/search.py.
+
+POSTGRES_FORWARDS = [
+    """
+    ALTER TABLE chat_room_message ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+    """,
+    "CREATE INDEX chat_room_message_search_idx ON chat_room_message USING GIN (search_vector)",
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS chat_room_message_search_idx",
+    "ALTER TABLE chat_room_message DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE chat_room_message_fts USING fts5(
+        content, content='chat_room_message', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_room_message_fts_insert AFTER INSERT ON chat_room_message BEGIN
+        INSERT INTO chat_room_message_fts(rowid, content) VALUES (new.id, coalesce(new.content, ''));
+    END
+    """,
+    """
+    CREATE TRIGGER chat_room_message_fts_delete AFTER DELETE ON chat_room_message BEGIN
+        INSERT INTO chat_room_message_fts(chat_room_message_fts, rowid, content)
+        VALUES ('delete', old.id, coalesce(old.content, ''));
+    END
+    """,
+    """
+    CREATE TRIGGER chat_room_message_fts_update AFTER UPDATE OF content ON chat_room_message BEGIN
+        INSERT INTO chat_room_message_fts(chat_room_message_fts, rowid, content)
+        VALUES ('delete', old.id, coalesce(old.content, ''));
+        INSERT INTO chat_room_message_fts(rowid, content) VALUES (new.id, coalesce(new.content, ''));
+    END
+    """,
+    "INSERT INTO chat_room_message_fts(chat_room_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS chat_room_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_room_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_room_message_fts_update",
+    "DROP TABLE IF EXISTS chat_room_message_fts",
+]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0008_chatroom_activity_idx'),
+    ]
+
+    operations = [
+        # A B-tree on the whole text can't serve substring or word search and slows every insert
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_room_m_content_675e06_idx',
+        ),
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARDS, SQLITE_FORWARDS),
+            run_for_vendor(POSTGRES_BACKWARDS, SQLITE_BACKWARDS),
+        ),
+    ]
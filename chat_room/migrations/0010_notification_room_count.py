@@ -0,0 +1,50 @@
+# Generated by Django 5.2 on 2026-10-16 21:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+
+
+def collapse_unread_notifications(apps, schema_editor):
+    # Fills in the room of existing notifications and collapses the unread new_message
+    # ones of each user and room into the latest, counting the others
+    Notification = apps.get_model('chat_room', 'Notification')
+    Message = apps.get_model('chat_room', 'Message')
+    Notification.objects.filter(message__isnull=False).update(
+        room_id=Subquery(Message.objects.filter(id=OuterRef('message_id')).values('room_id')[:1])
+    )
+
+    unread = Notification.objects.filter(is_read=False, notification_type='new_message', room__isnull=False)
+    duplicates = unread.values('user_id', 'room_id').order_by().annotate(
+        total=Count('id'), latest=Max('id')
+    ).filter(total__gt=1)
+    for group in duplicates.iterator():
+        Notification.objects.filter(id=group['latest']).update(count=group['total'])
+        unread.filter(user_id=group['user_id'], room_id=group['room_id']).exclude(id=group['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0009_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='room',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='chat_room.chatroom'),
+        ),
+        migrations.RunPython(collapse_unread_notifications, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_read', False), ('notification_type', 'new_message')), fields=('user', 'room'), name='notification_unread_room_uniq'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-16 21:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0010_notification_room_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat_room.message'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-16 21:17
+
+import cloudinary_storage.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0011_notification_message_set_null'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatroom',
+            name='group_image',
+            field=models.ImageField(blank=True, default='media/profile_pic/default.png', null=True, storage=cloudinary_storage.storage.MediaCloudinaryStorage(), upload_to='media/chat/group_images'),
+        ),
+    ]
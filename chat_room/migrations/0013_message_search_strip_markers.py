@@ -0,0 +1,62 @@
+from importlib import import_module
+from django.db import migrations
+
+# Search highlights mark matches with the \x02 and \x03 control characters, see
+# chat_room/search.py. PostgreSQL drops those characters from the content before
+# highlighting. On SQLite the FTS5 table now reads the content through a view
+# that drops them too, so marker characters typed into a message can't pass
+# for matches. PostgreSQL is left as it is.
+
+message_search = import_module('chat_room.migrations.0009_message_search')
+
+# Must be the same expression as the view's, the index deletes what it was given
+STRIPPED = "replace(replace(coalesce({}.content, ''), char(2), ''), char(3), '')"
+
+SQLITE_FORWARDS = message_search.SQLITE_BACKWARDS + [
+    f"""
+    CREATE VIEW chat_room_message_search AS
+    SELECT id, {STRIPPED.format('chat_room_message')} AS content FROM chat_room_message
+    """,
+    """
+    CREATE VIRTUAL TABLE chat_room_message_fts USING fts5(
+        content, content='chat_room_message_search', content_rowid='id'
+    )
+    """,
+    f"""
+    CREATE TRIGGER chat_room_message_fts_insert AFTER INSERT ON chat_room_message BEGIN
+        INSERT INTO chat_room_message_fts(rowid, content) VALUES (new.id, {STRIPPED.format('new')});
+    END
+    """,
+    f"""
+    CREATE TRIGGER chat_room_message_fts_delete AFTER DELETE ON chat_room_message BEGIN
+        INSERT INTO chat_room_message_fts(chat_room_message_fts, rowid, content)
+        VALUES ('delete', old.id, {STRIPPED.format('old')});
+    END
+    """,
+    f"""
+    CREATE TRIGGER chat_room_message_fts_update AFTER UPDATE OF content ON chat_room_message BEGIN
+        INSERT INTO chat_room_message_fts(chat_room_message_fts, rowid, content)
+        VALUES ('delete', old.id, {STRIPPED.format('old')});
+        INSERT INTO chat_room_message_fts(rowid, content) VALUES (new.id, {STRIPPED.format('new')});
+    END
+    """,
+    "INSERT INTO chat_room_message_fts(chat_room_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARDS = message_search.SQLITE_BACKWARDS + [
+    "DROP VIEW IF EXISTS chat_room_message_search",
+] + message_search.SQLITE_FORWARDS
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0012_alter_chatroom_group_image'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            message_search.run_for_vendor([], SQLITE_FORWARDS),
+            message_search.run_for_vendor([], SQLITE_BACKWARDS),
+        ),
+    ]
@@ -1,4 +1,7 @@
 from django.db import models, transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from user_api.models import User
 import uuid
 from django.core.exceptions import ValidationError
@@ -12,6 +15,7 @@ class ChatRoom(models.Model):
     room_name = models.CharField(max_length=200, null=True, blank=True)
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
     creator = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="created_rooms")
     participants = models.ManyToManyField(User, related_name='chat_rooms')
     admins = models.ManyToManyField(User, related_name='admin_rooms')
@@ -23,6 +27,8 @@ class ChatRoom(models.Model):
         indexes = [
             models.Index(fields=['is_group', 'created_at', 'last_message']),
             models.Index(fields=['sharable_room_id']),
+            # Backs the chat list's keyset pagination on (last_activity_at, id)
+            models.Index(fields=['last_activity_at', 'id'], name='chatroom_activity_idx'),
         ]
 
     def __str__(self):
@@ -36,9 +42,11 @@ class ChatRoom(models.Model):
             raise ValidationError("A group cannot have more than 50 members.")
 
     def save(self, *args, **kwargs):
-        # Optional safety: auto-set is_group if > 2 participants after save
+        # Optional safety: auto-set is_group if > 2 participants after a full save
         super().save(*args, **kwargs)
-        if self.pk and self.participants.count() > 2 and not self.is_group:
+        if kwargs.get('update_fields') is not None:
+            return
+        if self.pk and not self.is_group and self.participants.count() > 2:
             self.is_group = True
             super().save(update_fields=["is_group"])
 
@@ -53,9 +61,15 @@ class ChatRoom(models.Model):
         self.participants.remove(user)
         self.admins.remove(user)
 
-    def update_last_message(self, message):
-        self.last_message = message
-        self.save(update_fields=['last_message'])
+    @classmethod
+    def update_last_message(cls, message):
+        # One UPDATE that skips save(), so no group conversion check runs per message.
+        # Writers in different workers can commit out of order, an older message never
+        # replaces a newer one.
+        cls.objects.filter(
+            Q(last_activity_at__lte=message.timestamp) | Q(last_activity_at__isnull=True),
+            pk=message.room_id,
+        ).update(last_message=message, last_activity_at=message.timestamp)
 
     def convert_to_group(self, creator_user):
         if not self.is_group:
@@ -103,34 +117,58 @@ class Message(models.Model):
         ordering = ['-timestamp']
         indexes = [
             models.Index(fields=['room', 'timestamp']),
-            models.Index(fields=['content']),
         ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:30]}" if self.content else f"{self.sender.username}: [Image]"
 
     def save(self, *args, **kwargs):
-        """Save message and update last message in room if new"""
+        """Save message and update last message in room if new, in one transaction"""
         is_new = self.pk is None
-        super().save(*args, **kwargs)
-        if is_new:
-            self.room.update_last_message(self)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new:
+                ChatRoom.update_last_message(self)
 
 
 # ------------------------------
-# MessageReadStatus model
+# ReadWatermark model
 # ------------------------------
-class MessageReadStatus(models.Model):
-    """Tracks which users have read which messages"""
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='read_statuses')
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    timestamp = models.DateTimeField(auto_now_add=True)
+class ReadWatermark(models.Model):
+    """Tracks the last message each participant has read in a room, everything up to it counts as read"""
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_watermarks')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_watermarks')
+    last_read_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        unique_together = ('message', 'user')
-        indexes = [
-            models.Index(fields=['user', 'message']),
-        ]
+        unique_together = ('room', 'user')
+
+    def __str__(self):
+        return f"{self.user.username} read room {self.room_id} up to message {self.last_read_id}"
+
+    @classmethod
+    def advance(cls, room_id, user_id, message_id):
+        """Moves the user's watermark forward to message_id, returns True if it moved"""
+        behind = cls.objects.filter(room_id=room_id, user_id=user_id, last_read_id__lt=message_id)
+        if behind.update(last_read_id=message_id, updated_at=timezone.now()):
+            return True
+        _, created = cls.objects.get_or_create(
+            room_id=room_id, user_id=user_id, defaults={'last_read_id': message_id}
+        )
+        if created:
+            return True
+        # The row exists, possibly created by a concurrent first advance to a lower message
+        return bool(behind.update(last_read_id=message_id, updated_at=timezone.now()))
+
+    @classmethod
+    def unread_count_subquery(cls, user):
+        """Subquery counting messages from others past the user's watermark, for annotating rooms"""
+        watermark = cls.objects.filter(room=OuterRef(OuterRef('pk')), user=user).values('last_read_id')[:1]
+        unread = Message.objects.filter(
+            room=OuterRef('pk'), id__gt=Coalesce(Subquery(watermark), 0)
+        ).exclude(sender=user).order_by().values('room').annotate(count=Count('id')).values('count')
+        return Coalesce(Subquery(unread), 0)
 
 
 # ------------------------------
@@ -146,7 +184,12 @@ class Notification(models.Model):
     )
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, blank=True, null=True)
+    # For new_message notifications, the latest of the messages counted. Deleting it
+    # mustn't take the count of the other messages with it.
+    message = models.ForeignKey(Message, on_delete=models.SET_NULL, blank=True, null=True)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, blank=True, null=True, related_name='notifications')
+    # Number of messages a new_message notification stands for
+    count = models.PositiveIntegerField(default=1)
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
     notification_type = models.CharField(max_length=50, choices=NOTIFICATION_TYPES, default='new_message')
@@ -156,6 +199,14 @@ class Notification(models.Model):
             models.Index(fields=['user', 'is_read']),
             models.Index(fields=['timestamp']),
         ]
+        constraints = [
+            # New messages collapse into one unread notification per user and room
+            models.UniqueConstraint(
+                fields=['user', 'room'],
+                condition=models.Q(is_read=False, notification_type='new_message'),
+                name='notification_unread_room_uniq',
+            ),
+        ]
         ordering = ['-timestamp']
 
     def __str__(self):
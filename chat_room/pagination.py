@@ -1,4 +1,135 @@
-from rest_framework.pagination import CursorPagination
+import json
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+
+
+# Cursor pagination that seeks on the whole ordering tuple instead of the
+# first field plus an offset, so any page costs one index range scan of
+# page size rows no matter how deep it is. The primary key is appended to
+# the ordering when missing so positions are unique.
+class KeysetCursorPagination(CursorPagination):
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            descending = ordering[0].startswith('-')
+            ordering = (*ordering, '-pk' if descending else 'pk')
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.model = queryset.model
+        self.annotations = queryset.query.annotations
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        queryset = queryset.order_by(*self.order_by(reverse))
+        if self.cursor is not None:
+            queryset = queryset.filter(self.seek(self.decode_position(self.cursor.position), reverse))
+
+        # One extra row tells whether there's more in the direction we're going
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.encode_position(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.encode_position(self.page[0])))
+
+    def fields(self):
+        # (name, model field, descending) for every ordering field, annotations use their output field
+        for ordering in self.ordering:
+            name = ordering.lstrip('-')
+            if name in self.annotations:
+                field = self.annotations[name].output_field
+            elif name == 'pk':
+                field = self.model._meta.pk
+            else:
+                field = self.model._meta.get_field(name)
+            yield name, field, ordering.startswith('-')
+
+    def order_by(self, reverse):
+        # Nullable fields always sort their nulls last going forward, the same on every database
+        order_by = []
+        for name, field, descending in self.fields():
+            descending = descending != reverse
+            if not field.null:
+                order_by.append(f"-{name}" if descending else name)
+            else:
+                nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+                order_by.append(F(name).desc(**nulls) if descending else F(name).asc(**nulls))
+        return order_by
+
+    def seek(self, position, reverse):
+        """
+        Filter for the rows after the position in the iteration order:
+        (a > x) or (a = x and b > y) or ... with the comparison following each field's direction.
+        """
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (name, field, descending), value in zip(self.fields(), position):
+            descending = descending != reverse
+            nulls_first = field.null and reverse
+            if value is None:
+                after = Q(**{f"{name}__isnull": False}) if nulls_first else Q(pk__in=[])
+                same = Q(**{f"{name}__isnull": True})
+            else:
+                after = Q(**{f"{name}__lt" if descending else f"{name}__gt": value})
+                if field.null and not nulls_first:
+                    after |= Q(**{f"{name}__isnull": True})
+                same = Q(**{name: value})
+            condition |= equal & after
+            equal &= same
+
+        # Bound on the leading column so the database can range scan its index
+        name, field, descending = next(self.fields())
+        if not field.null:
+            descending = descending != reverse
+            condition &= Q(**{f"{name}__lte" if descending else f"{name}__gte": position[0]})
+        return condition
+
+    def encode_position(self, instance):
+        # Full precision isoformat, DjangoJSONEncoder would cut datetimes to milliseconds
+        values = [getattr(instance, name) for name, _, _ in self.fields()]
+        return json.dumps(
+            [value.isoformat() if hasattr(value, 'isoformat') else value for value in values],
+            default=str
+        )
+
+    def decode_position(self, position):
+        try:
+            values = json.loads(position)
+            fields = list(self.fields())
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError
+            return [
+                None if value is None else field.to_python(value)
+                for (_, field, _), value in zip(fields, values)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
 
 # For paginating messages (newest first)
 class MessageCursorPagination(CursorPagination):
@@ -6,6 +137,14 @@ class MessageCursorPagination(CursorPagination):
     ordering = '-timestamp'
 
 # For paginating chats (most recent activity first)
-class ChatCursorPagination(CursorPagination):
+class ChatCursorPagination(KeysetCursorPagination):
     page_size = 35
-    ordering = '-last_message'
\ No newline at end of file
+    ordering = ('-last_activity_at', '-id')
+
+# For paginating search hits (most relevant first), the order can't be changed by filters
+class MessageSearchPagination(KeysetCursorPagination):
+    page_size = 35
+    ordering = ('-rank', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
@@ -1,13 +1,25 @@
 from rest_framework.permissions import BasePermission
+from .membership import is_member
 
-# Checks if user is a participant in a room
+# Checks if user is a participant in a room, through the cached member sets
 class IsRoomParticipant(BasePermission):
+    def has_permission(self, request, view):
+        # Routes nested under a room are checked before anything is loaded
+        chatroom_pk = view.kwargs.get('chatroom_pk')
+        if chatroom_pk is None:
+            return True
+        try:
+            room_id = int(chatroom_pk)
+        except (TypeError, ValueError):
+            return False
+        return bool(request.user and request.user.is_authenticated) and is_member(room_id, request.user.id)
+
     def has_object_permission(self, request, view, obj):
         if hasattr(obj, 'participants'):
-            return request.user in obj.participants.all()
-        elif hasattr(obj, 'room'):
+            return is_member(obj.pk, request.user.id)
+        elif hasattr(obj, 'room_id'):
             # For message objects that belong to a room
-            return request.user in obj.room.participants.all()
+            return is_member(obj.room_id, request.user.id)
 
 # Checks if user is an admin of a room
 class IsRoomAdmin(BasePermission):
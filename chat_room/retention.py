@@ -0,0 +1,56 @@
+import gzip
+import json
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from .models import Notification
+
+# Read notifications are kept for NOTIFICATION_RETENTION_DAYS and then deleted,
+# optionally archived first. Rows go oldest first in batches by primary key,
+# each batch its own short transaction, so pruning never holds locks on more
+# than one batch and clients keep writing notifications meanwhile.
+
+
+def expired_notifications(retention_days=None):
+    retention_days = settings.NOTIFICATION_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    return Notification.objects.filter(is_read=True, timestamp__lt=cutoff)
+
+
+def archive_rows(archive, rows):
+    # One JSON object per line; every run appends a gzip member, which gzip readers concatenate
+    with gzip.open(archive, "at", encoding="utf-8") as file:
+        for row in rows:
+            file.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+
+
+def prune_notifications(retention_days=None, batch_size=None, archive=None, pause=0):
+    """
+    Deletes the read notifications older than the retention period and returns
+    how many were deleted. With `archive`, a path, the rows are appended to it
+    as gzipped NDJSON before they're deleted. Sleeps `pause` seconds between
+    batches to leave the database room for other writes.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_PRUNE_BATCH_SIZE
+    expired = expired_notifications(retention_days).order_by('timestamp', 'id')
+    columns = [field.attname for field in Notification._meta.concrete_fields]
+    deleted = 0
+    while True:
+        if archive:
+            rows = list(expired.values(*columns)[:batch_size])
+            ids = [row['id'] for row in rows]
+            if rows:
+                archive_rows(archive, rows)
+        else:
+            ids = list(expired.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+
+        # Nothing references notifications, so this is a single DELETE by primary key
+        deleted += Notification.objects.filter(id__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,134 @@
+import re
+from html import escape
+from django.db import connections
+from django.db.models import BooleanField, F, FloatField, TextField, Value
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import BaseFilterBackend
+
+# Message search runs on the index created by migrations 0009 and 0013: the
+# generated search_vector column on PostgreSQL, the chat_room_message_fts
+# table on SQLite. Any other database falls back to an unindexed icontains scan.
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_STOP = "</mark>"
+
+# The database wraps matches in these control characters instead of the tags, so
+# the content around them can be escaped before they become tags, see render_highlight
+MATCH_START = "\x02"
+MATCH_STOP = "\x03"
+
+# PostgreSQL text search configuration, must match the one of the generated column
+SEARCH_CONFIG = "simple"
+
+
+def _vendor(queryset):
+    return connections[queryset.db].vendor
+
+
+def fts5_query(query):
+    # Every word becomes a quoted FTS5 string, so user input can't use or break the query syntax
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+
+
+def search_messages(queryset, query):
+    """Filters a message queryset down to the messages matching the query."""
+    query = query.strip()
+    if not query:
+        return queryset.none()
+
+    vendor = _vendor(queryset)
+    if vendor == "postgresql":
+        return queryset.filter(RawSQL(
+            f'"chat_room_message"."search_vector" @@ websearch_to_tsquery(\'{SEARCH_CONFIG}\', %s)',
+            [query], output_field=BooleanField()
+        ))
+    if vendor == "sqlite":
+        return queryset.filter(id__in=RawSQL(
+            "SELECT rowid FROM chat_room_message_fts WHERE chat_room_message_fts MATCH %s",
+            [fts5_query(query)]
+        ))
+    return queryset.filter(content__icontains=query)
+
+
+def rank_messages(queryset, query):
+    """
+    Like search_messages, with a `rank` annotation (higher is more relevant) and a
+    `highlight` annotation: the content with matches wrapped in MATCH_START and
+    MATCH_STOP, which render_highlight turns into safe HTML.
+    """
+    queryset = search_messages(queryset, query)
+    query = query.strip()
+    vendor = _vendor(queryset)
+
+    if vendor == "postgresql":
+        tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        return queryset.annotate(
+            # Cast to double so the rank survives a round trip through a cursor exactly
+            rank=RawSQL(
+                f'ts_rank("chat_room_message"."search_vector", {tsquery})::double precision',
+                [query], output_field=FloatField()
+            ),
+            # Marker characters typed into a message are dropped so they can't pass for matches
+            highlight=RawSQL(
+                f"ts_headline('{SEARCH_CONFIG}', translate(coalesce(\"chat_room_message\".\"content\", ''), %s, ''), "
+                f"{tsquery}, %s)",
+                [MATCH_START + MATCH_STOP, query, f'StartSel="{MATCH_START}", StopSel="{MATCH_STOP}", HighlightAll=true'],
+                output_field=TextField()
+            ),
+        )
+    if vendor == "sqlite":
+        # bm25 and highlight only work inside a MATCH query, so each hit looks itself up in the index.
+        # The index reads the content through a view without marker characters, like translate above.
+        match = (
+            "FROM chat_room_message_fts WHERE chat_room_message_fts MATCH %s "
+            "AND chat_room_message_fts.rowid = \"chat_room_message\".\"id\""
+        )
+        return queryset.annotate(
+            rank=RawSQL(f"(SELECT -bm25(chat_room_message_fts) {match})", [fts5_query(query)],
+                        output_field=FloatField()),
+            highlight=RawSQL(
+                f"(SELECT highlight(chat_room_message_fts, 0, %s, %s) {match})",
+                [MATCH_START, MATCH_STOP, fts5_query(query)],
+                output_field=TextField()
+            ),
+        )
+    return queryset.annotate(rank=Value(0.0, output_field=FloatField()), highlight=F("content"))
+
+
+def render_highlight(highlight):
+    """HTML of a highlight annotation: the content escaped, with matches wrapped in <mark> tags."""
+    if highlight is None:
+        return None
+    html = []
+    in_match = False
+    for part in re.split(f"([{MATCH_START}{MATCH_STOP}])", highlight):
+        if part in (MATCH_START, MATCH_STOP):
+            # Unpaired markers can only come from the content itself and are dropped
+            if (part == MATCH_START) != in_match:
+                in_match = not in_match
+                html.append(HIGHLIGHT_START if in_match else HIGHLIGHT_STOP)
+        else:
+            html.append(escape(part))
+    if in_match:
+        html.append(HIGHLIGHT_STOP)
+    return "".join(html)
+
+
+# Drop-in replacement for SearchFilter on message lists: ?search= goes through the search index
+class MessageSearchFilter(BaseFilterBackend):
+    search_param = "search"
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "").strip()
+        if not query:
+            return queryset
+        return search_messages(queryset, query)
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            "name": self.search_param,
+            "required": False,
+            "in": "query",
+            "description": "Words the message content has to contain.",
+            "schema": {"type": "string"},
+        }]
@@ -5,12 +5,14 @@ from .chatroom_serializers import (
     )
 from .message_serializers import (
     MessageSerializer, MessageCreateSerializer,
-    MessageReadStatusSerializer, BasicMessageSerializer
+    ReadWatermarkSerializer, BasicMessageSerializer,
+    MessageHistoryParamsSerializer, MessageSearchHitSerializer
 )
 from .notification_serializers import NotificationSerializer
 
 __all__ = [
     "ChatRoomSerializer", "ChatRoomCreateSerializer", "AddMemberSerializer", "RemoveMemberSerializer",
     "MessageSerializer", "MessageCreateSerializer",
-    "MessageReadStatusSerializer", "BasicMessageSerializer", "NotificationSerializer",
+    "ReadWatermarkSerializer", "BasicMessageSerializer", "NotificationSerializer",
+    "MessageHistoryParamsSerializer", "MessageSearchHitSerializer",
 ]
\ No newline at end of file
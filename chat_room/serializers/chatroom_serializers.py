@@ -5,11 +5,11 @@ from ..models import ChatRoom
 from .message_serializers import BasicMessageSerializer, BasicUserSerializer
 from django.contrib.auth import get_user_model
 from user_api.serializers import UserSerializer
+from user_api.presence import PresenceFieldsMixin, PresenceListSerializer
 User = get_user_model()
-from django_redis import get_redis_connection
 
 
-class ParticipantUserSerializer(serializers.ModelSerializer):
+class ParticipantUserSerializer(PresenceFieldsMixin, serializers.ModelSerializer):
     is_admin = serializers.SerializerMethodField()
     online_status = serializers.SerializerMethodField()
     last_seen = serializers.SerializerMethodField()
@@ -18,19 +18,7 @@ class ParticipantUserSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username','full_name', 'is_admin' ,'profile_pic','online_status', 'last_seen']
         read_only_fields = ['id', 'username', 'email']
-    
-    def get_online_status(self, obj) -> bool:
-        conn = get_redis_connection("default")
-        return conn.get(f"user:{obj.id}:online") == b"1"
-    
-
-    def get_last_seen(self, obj) -> str:
-        conn = get_redis_connection("default")
-        last_seen = conn.get(f"user:{obj.id}:last_seen")
-        if last_seen:
-            import datetime
-            return datetime.datetime.fromisoformat(last_seen.decode())
-        return None
+        list_serializer_class = PresenceListSerializer
     
     def get_is_admin(self, obj) -> bool:
         admin_ids = self.context.get('chatroom_admin_ids', [])
@@ -45,21 +33,25 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
     chat_name = serializers.SerializerMethodField()
     group_image = serializers.SerializerMethodField()
     last_message = BasicMessageSerializer(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True, default=0)
 
     class Meta:
         model = ChatRoom
-        fields = ['id','group_image', 'chat_name', 'is_group', 'last_message']
+        fields = ['id','group_image', 'chat_name', 'is_group', 'last_message', 'unread_count']
+
+    def get_other_participant(self, obj):
+        # The list view prefetches the other participant, fall back to a query otherwise
+        if hasattr(obj, 'other_participants'):
+            return obj.other_participants[0] if obj.other_participants else None
+        return obj.participants.exclude(id=self.context.get('request').user.id).first()
 
     @extend_schema_field(str)
     def get_chat_name(self, obj):
         if obj.is_group:
             return obj.room_name
         
-        user = self.context.get('request').user
-        other_participants = obj.participants.exclude(id=user.id)
-        
-        if other_participants.exists():
-            participant = other_participants.first()
+        participant = self.get_other_participant(obj)
+        if participant:
             return (participant.first_name and participant.last_name and f"{participant.first_name} {participant.last_name}") or participant.username
         
         return None
@@ -74,10 +66,8 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
         if obj.is_group:
             return build_absolute_url(obj.group_image.url if obj.group_image else None)
 
-        user = request.user
-        other_participants = obj.participants.exclude(id=user.id)
-        if other_participants.exists():
-            participant = other_participants.first()
+        participant = self.get_other_participant(obj)
+        if participant:
             return build_absolute_url(participant.profile_pic.url if participant.profile_pic else None)
 
         return None
@@ -1,6 +1,9 @@
 from rest_framework import serializers
-from ..models import ChatRoom, Message, MessageReadStatus
+from ..models import Message, ReadWatermark
+from ..membership import is_member
+from ..search import render_highlight
 from django.contrib.auth import get_user_model
+from Django_Chat.serializers import PrefetchListSerializer
 
 User = get_user_model()
 
@@ -11,13 +14,13 @@ class BasicUserSerializer(serializers.ModelSerializer):
         fields = ['id']
         read_only_fields = ['id'] 
 
-# Serializer for individual read status records of a message
-class MessageReadStatusSerializer(serializers.ModelSerializer):
-    user = BasicUserSerializer(read_only=True)  # Serialize the user who read the message
+# Serializer for a participant's read watermark in a room
+class ReadWatermarkSerializer(serializers.ModelSerializer):
+    user = BasicUserSerializer(read_only=True)  # Serialize the user who read up to the watermark
 
     class Meta:
-        model = MessageReadStatus
-        fields = ['id', 'user', 'timestamp']
+        model = ReadWatermark
+        fields = ['id', 'user', 'last_read_id', 'updated_at']
 
 
 #serializer for displaying message previews (e.g., last message in a chat)
@@ -32,13 +35,87 @@ class BasicMessageSerializer(serializers.ModelSerializer):
         return obj.sender.username if obj.sender else None
 
 
+# Loads the read watermarks of every room on the page in one query before rendering rows
+class MessageListSerializer(PrefetchListSerializer):
+    def prefetch(self, objects):
+        if self.context.get('receipts', 'ids') != 'none':
+            prefetch_room_watermarks(self.context, {message.room_id for message in objects})
+
+
+def prefetch_room_watermarks(context, room_ids):
+    """Memoizes (user_id, last_read_id) pairs per room in the serializer context."""
+    watermarks = context.setdefault('room_watermarks', {})
+    missing = [room_id for room_id in room_ids if room_id not in watermarks]
+    if missing:
+        for room_id in missing:
+            watermarks[room_id] = []
+        rows = ReadWatermark.objects.filter(room_id__in=missing).values_list('room_id', 'user_id', 'last_read_id')
+        for room_id, user_id, last_read_id in rows:
+            watermarks[room_id].append((user_id, last_read_id))
+    return watermarks
+
+
 # serializer for retrieving message details including read status
 class MessageSerializer(serializers.ModelSerializer):
+    # How much read status each message carries, picked with the `receipts` context key:
+    # "ids" (reader ids and count, the default), "count" (count only) or "none"
+    RECEIPT_MODES = ('ids', 'count', 'none')
+
     sender = BasicUserSerializer()
-    read_statuses = MessageReadStatusSerializer(many=True, read_only=True) 
+    read_by = serializers.SerializerMethodField()
+    read_count = serializers.SerializerMethodField()
     class Meta:
         model = Message
-        fields = ['id', 'room', 'sender', 'content', 'timestamp', 'image', 'read_statuses']
+        fields = ['id', 'room', 'sender', 'content', 'timestamp', 'image', 'read_by', 'read_count']
+        list_serializer_class = MessageListSerializer
+
+    def get_fields(self):
+        fields = super().get_fields()
+        receipts = self.context.get('receipts', 'ids')
+        if receipts != 'ids':
+            fields.pop('read_by')
+        if receipts == 'none':
+            fields.pop('read_count')
+        return fields
+
+    def get_readers(self, obj):
+        # Readers are derived from the room's watermarks, loaded once per room
+        watermarks = prefetch_room_watermarks(self.context, [obj.room_id])
+        return [
+            user_id for user_id, last_read_id in watermarks[obj.room_id]
+            if last_read_id >= obj.id and user_id != obj.sender_id
+        ]
+
+    def get_read_by(self, obj) -> list[int]:
+        return self.get_readers(obj)
+
+    def get_read_count(self, obj) -> int:
+        return len(self.get_readers(obj))
+
+# A search hit: the message plus its relevance and the content with matches highlighted
+class MessageSearchHitSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+    highlight = serializers.SerializerMethodField()
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['rank', 'highlight']
+
+    def get_highlight(self, obj) -> str:
+        # HTML escaped content with matches in <mark> tags, safe to insert as markup
+        return render_highlight(obj.highlight)
+
+
+# Query parameters of the anchored history endpoint
+class MessageHistoryParamsSerializer(serializers.Serializer):
+    DIRECTIONS = ('before', 'after', 'around')
+
+    anchor = serializers.IntegerField(help_text="ID of the message to load history from")
+    direction = serializers.ChoiceField(
+        choices=DIRECTIONS, default='around',
+        help_text="before/after exclude the anchor, around includes it in the middle"
+    )
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=35)
+
 
 # Serializer for creating new messages
 class MessageCreateSerializer(serializers.ModelSerializer):
@@ -46,8 +123,15 @@ class MessageCreateSerializer(serializers.ModelSerializer):
         model = Message
         fields = ['id', 'content', 'image'] 
 
+    def validate(self, data):
+        # Only members can post, checked against the cached member set of the room
+        room_id = int(self.context['view'].kwargs['chatroom_pk'])
+        if not is_member(room_id, self.context['request'].user.id):
+            raise serializers.ValidationError("You are not a participant of this room.")
+        return data
+
     def create(self, validated_data) -> Message:
         # Automatically assign sender and room based on context
         validated_data['sender'] = self.context['request'].user
-        validated_data['room'] = ChatRoom.objects.get(pk=self.context['view'].kwargs['chatroom_pk'])
+        validated_data['room_id'] = int(self.context['view'].kwargs['chatroom_pk'])
         return super().create(validated_data)
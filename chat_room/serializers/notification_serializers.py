@@ -8,29 +8,36 @@ class NotificationSerializer(serializers.ModelSerializer):
     chat_name = serializers.SerializerMethodField()
     class Meta:
         model = Notification
-        fields = ['id', 'sender', 'message', 'chat_name', 'timestamp', 'is_read']
+        # For new_message notifications, count is the number of unread messages and message the latest one
+        fields = ['id', 'sender', 'message', 'chat_name', 'room', 'count', 'timestamp', 'is_read']
+        # Notifications are marked read through mark_read and mark_all_read only
+        read_only_fields = ['room', 'count', 'is_read']
+
+    # The message is None once it's deleted, a collapsed notification keeps its room and count
 
     def get_sender(self, obj) -> str:
         # Return sender's username from the related message
-        return obj.message.sender.username
+        return obj.message.sender.username if obj.message else None
 
     def get_room_name(self, obj) -> str:
         # Return the chat room name from the related message
-        return obj.message.room.room_name
+        room = obj.room or (obj.message.room if obj.message else None)
+        return room.room_name if room else None
 
     def get_message(self, obj) -> str:
         # Return message content
-        return obj.message.content
+        return obj.message.content if obj.message else None
     
     def get_chat_name(self, obj):
-        if not obj.message or not obj.message.room:
+        room = obj.room or (obj.message.room if obj.message else None)
+        if not room:
             return None
         
-        if obj.message.room.is_group:
-            return obj.message.room.room_name
+        if room.is_group:
+            return room.room_name
         
         user = self.context.get('request').user
-        other_participants = obj.message.room.participants.exclude(id=user.id)
+        other_participants = room.participants.exclude(id=user.id)
         
         if other_participants.exists():
             participant = other_participants.first()
@@ -0,0 +1,42 @@
+import asyncio
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+
+# Each sidebar socket joins only its own user's group, so updates reach
+# the participants of a room instead of every online user
+def sidebar_group_name(user_id):
+    return f"sidebar_{user_id}"
+
+
+def last_message_update(message):
+    # Sidebar event refreshing a room's last message preview
+    return {
+        "type": "last_message_updated",
+        "group_id": message.room_id,
+        "last_message": {
+            "id": message.id,
+            "text": message.content,
+            "sender": message.sender.username,
+            "timestamp": message.timestamp.isoformat()
+        }
+    }
+
+
+async def send_sidebar_update(user_ids, data):
+    """Sends a sidebar event to the personal sidebar group of every given user."""
+    channel_layer = get_channel_layer()
+    event = {
+        "type": "group.update",
+        "data": data,
+    }
+    await asyncio.gather(*(
+        channel_layer.group_send(sidebar_group_name(user_id), event)
+        for user_id in set(user_ids)
+    ))
+
+
+def broadcast_sidebar_update(user_ids, data):
+    # Sync entry point for views and signals, one event loop bridge per call.
+    # Querysets are evaluated here since the database can't be hit from the loop
+    async_to_sync(send_sidebar_update)(list(user_ids), data)
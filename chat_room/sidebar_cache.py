@@ -0,0 +1,161 @@
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+from Django_Chat.stats import BatchedCounters
+from .serializers import BasicMessageSerializer
+
+# Every user's first chat list page is kept as a rendered snapshot in redis.
+# New messages patch the snapshots of the room's members in place, anything
+# else that changes a list entry (membership, room edits, reads) drops them.
+# Each user also has a version counter bumped on every invalidation: a list
+# request only stores its snapshot if no invalidation happened while it was
+# rendering, so a snapshot never misses a change committed in the meantime.
+
+# Snapshot hits and misses, added to redis every SIDEBAR_STATS_FLUSH_EVERY counts
+_stats = BatchedCounters("sidebar:snapshot_stats")
+
+
+def snapshot_key(user_id):
+    return f"user:{user_id}:sidebar"
+
+
+def version_key(user_id):
+    return f"user:{user_id}:sidebar_version"
+
+
+def load_snapshot(user_id):
+    """Returns the user's cached first page (or None) and the snapshot version to store a fresh one under."""
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    pipe.mget([snapshot_key(user_id), version_key(user_id)])
+    _stats.flush_into(pipe, settings.SIDEBAR_STATS_FLUSH_EVERY)
+    raw, version = pipe.execute()[0]
+    version = int(version or 0)
+
+    snapshot = json.loads(raw) if raw else None
+    if snapshot is not None and snapshot["version"] != version:
+        snapshot = None
+    _stats.count("hits" if snapshot is not None else "misses")
+    return (snapshot["data"] if snapshot is not None else None), version
+
+
+def store_snapshot(user_id, version, data):
+    # Only store if the version read before rendering is still current
+    vkey = version_key(user_id)
+    with get_redis_connection("default").pipeline() as pipe:
+        try:
+            pipe.watch(vkey)
+            if int(pipe.get(vkey) or 0) != version:
+                return
+            pipe.multi()
+            pipe.set(
+                snapshot_key(user_id),
+                json.dumps({"version": version, "data": data}, cls=DjangoJSONEncoder),
+                ex=settings.SIDEBAR_SNAPSHOT_TTL
+            )
+            pipe.execute()
+        except WatchError:
+            pass
+
+
+def invalidate_snapshots(user_ids):
+    """Drops the snapshots of the given users in one pipelined round trip."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.delete(snapshot_key(user_id))
+        pipe.incr(version_key(user_id))
+        pipe.expire(version_key(user_id), settings.SIDEBAR_SNAPSHOT_TTL)
+    pipe.execute()
+
+
+def apply_new_messages(messages, room_members):
+    """
+    Moves the rooms of new messages to the top of their members' snapshots with
+    the new preview and unread count. Snapshots that don't contain the room are dropped.
+    """
+    latest_in_room = {}
+    for message in messages:
+        latest = latest_in_room.get(message.room_id)
+        if latest is None or message.id > latest.id:
+            latest_in_room[message.room_id] = message
+
+    # Every new message of a member's rooms, newest room last so it ends up on top
+    user_updates = {}
+    for room_id, message in sorted(latest_in_room.items(), key=lambda item: item[1].id):
+        for user_id in room_members.get(room_id, []):
+            user_updates.setdefault(user_id, []).append(message)
+    if not user_updates:
+        return
+
+    previews = {
+        message.room_id: BasicMessageSerializer(message).data
+        for message in latest_in_room.values()
+    }
+    # Unread counts grow by every message from someone else, not just the latest one
+    room_messages = {}
+    for message in messages:
+        room_messages.setdefault(message.room_id, []).append(message)
+
+    user_ids = list(user_updates)
+    keys = [snapshot_key(user_id) for user_id in user_ids]
+    stale = []
+    with get_redis_connection("default").pipeline() as pipe:
+        try:
+            # Watched so a concurrent patch or invalidation makes this one drop the snapshots instead
+            pipe.watch(*keys)
+            patched = {}
+            for user_id, key, raw in zip(user_ids, keys, pipe.mget(keys)):
+                snapshot = json.loads(raw) if raw else None
+                if snapshot is None or not _patch_entries(
+                        snapshot["data"]["results"], user_updates[user_id], previews, room_messages, user_id):
+                    stale.append(user_id)
+                else:
+                    patched[key] = snapshot
+
+            pipe.multi()
+            for key, snapshot in patched.items():
+                pipe.set(key, json.dumps(snapshot, cls=DjangoJSONEncoder), ex=settings.SIDEBAR_SNAPSHOT_TTL)
+            pipe.execute()
+        except WatchError:
+            stale = user_ids
+
+    # Users without a usable snapshot still get their version bumped, which
+    # keeps a list request that's rendering right now from caching old data
+    invalidate_snapshots(stale)
+
+
+def _patch_entries(results, messages, previews, room_messages, user_id):
+    entries = {entry["id"]: entry for entry in results}
+    if any(message.room_id not in entries for message in messages):
+        return False
+
+    for message in messages:
+        entry = entries[message.room_id]
+        # A snapshot rendered after the messages committed already shows them, only newer ones are applied
+        shown_id = (entry.get("last_message") or {}).get("id") or 0
+        if message.id <= shown_id:
+            continue
+        entry["last_message"] = previews[message.room_id]
+        entry["unread_count"] = entry.get("unread_count", 0) + sum(
+            1 for new in room_messages[message.room_id] if new.id > shown_id and new.sender_id != user_id
+        )
+        results.remove(entry)
+        results.insert(0, entry)
+    return True
+
+
+def snapshot_stats():
+    # Hit rate of the snapshots since the counters were last reset, see the cache_stats command
+    stats = _stats.totals()
+    hits = stats.get("hits", 0)
+    misses = stats.get("misses", 0)
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else None}
+
+
+def reset_snapshot_stats():
+    _stats.reset()
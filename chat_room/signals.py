@@ -1,11 +1,11 @@
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import ChatRoom, Message, Notification
+from .models import ChatRoom, Message, User
+from .dispatcher import notification_dispatcher
+from .sidebar_cache import invalidate_snapshots
+from .membership import invalidate_members
 import logging
 from django.db import transaction
-from django.db import IntegrityError
 
 # logger for error tracking
 logger = logging.getLogger(__name__)
@@ -41,50 +41,111 @@ def update_group_room_name(sender, instance, action, pk_set, **kwargs):
 
 @receiver(post_save, sender=Message)
 def create_message_notification(sender, instance, created, **kwargs):
-    """Creates notifications for new messages and sends them via WebSocket."""
+    """Queues notifications for new messages once the message is committed."""
     # Only process new messages
     if not created:
         return
-    
-    # Get chatroom and participants
-    chatroom = instance.room
-    participants = chatroom.participants.all()
-
-    # Prepare notifications for each participant (except sender)
-    notifications = []
-    for user in participants:
-        if user == instance.sender:
-            continue
-        notification = Notification(
-            user=user,
-            message=instance,
-            notification_type="new_message"
-        )
-        notifications.append(notification)
-
-    try:
-        # Save notifications in a single transaction
-        with transaction.atomic():
-            Notification.objects.bulk_create(notifications)
-    except Exception as e:
-        # Log any errors
-        logger.error(f"Error creating notifications for message {instance.id}: {e}")
-
-    # Send notifications via WebSocket
-    channel_layer = get_channel_layer()
-    for notification in notifications:
-        async_to_sync(channel_layer.group_send)(
-            f"notification_{notification.user.id}",
-            {
-                "type": "send_notification",
-                "message": {
-                    "message_id": instance.id,
-                    "sender": instance.sender.username,
-                    "room_id": chatroom.id,
-                    "content": instance.content[:50] + '...' if len(instance.content) > 50 else instance.content,
-                    "timestamp": notification.timestamp.isoformat() if notification.timestamp else None,
-                    "is_read": False,
-                    "notification_type": notification.notification_type
-                }
-            }
-        )
\ No newline at end of file
+
+    # Creating and sending notifications happens on the dispatcher, off the request path
+    transaction.on_commit(lambda: notification_dispatcher.dispatch([instance.id]))
+
+
+def invalidate_snapshots_on_commit(user_ids):
+    # Dropped once the change is visible, so no list request can cache the old state afterwards
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: invalidate_snapshots(user_ids))
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def invalidate_member_sidebars(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drops the sidebar snapshots of users who joined or left a room."""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # Changed from the user's side, user.chat_rooms.add(...)
+        invalidate_snapshots_on_commit([instance.pk])
+    elif action == 'pre_clear':
+        invalidate_snapshots_on_commit(instance.participants.values_list('id', flat=True))
+    else:
+        invalidate_snapshots_on_commit(pk_set)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def invalidate_room_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drops the cached member sets of rooms whose participants changed."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        room_ids = [instance.pk]
+    elif action == 'post_clear':
+        # The cleared rooms aren't known anymore, they were collected before the clear
+        room_ids = getattr(instance, '_cleared_room_ids', [])
+    else:
+        room_ids = list(pk_set)
+    transaction.on_commit(lambda: invalidate_members(room_ids))
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def collect_cleared_rooms(sender, instance, action, reverse, **kwargs):
+    # user.chat_rooms.clear() only says which user it was, remember the rooms first
+    if reverse and action == 'pre_clear':
+        instance._cleared_room_ids = list(instance.chat_rooms.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_deleted_room_members(sender, instance, **kwargs):
+    room_id = instance.pk
+    transaction.on_commit(lambda: invalidate_members([room_id]))
+
+
+@receiver(post_save, sender=ChatRoom)
+def invalidate_room_sidebars(sender, instance, created, **kwargs):
+    """Drops the sidebar snapshots of a room's members when the room is edited."""
+    # A new room has no members yet, they are added through the m2m
+    if created:
+        return
+    invalidate_snapshots_on_commit(instance.participants.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def invalidate_deleted_room_sidebars(sender, instance, **kwargs):
+    # Members are collected before the delete cascades to the m2m rows
+    invalidate_snapshots_on_commit(instance.participants.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Message)
+def invalidate_edited_message_sidebars(sender, instance, created, **kwargs):
+    # New messages patch the snapshots through the dispatcher, an edit may change the room's preview
+    if created:
+        return
+    invalidate_snapshots_on_commit(
+        ChatRoom.participants.through.objects.filter(
+            chatroom_id=instance.room_id
+        ).values_list('user_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_deleted_message_sidebars(sender, instance, **kwargs):
+    # The room's preview may have pointed at the deleted message
+    invalidate_snapshots_on_commit(
+        ChatRoom.participants.through.objects.filter(
+            chatroom_id=instance.room_id
+        ).values_list('user_id', flat=True)
+    )
+
+
+@receiver(post_save, sender=User)
+def invalidate_private_chat_sidebars(sender, instance, created, update_fields, **kwargs):
+    """Private chats show the other user's name and picture, so profile edits drop those snapshots."""
+    if created:
+        return
+    if update_fields is not None and not {'username', 'first_name', 'last_name', 'profile_pic'} & set(update_fields):
+        return
+    invalidate_snapshots_on_commit(
+        ChatRoom.participants.through.objects.filter(
+            chatroom__is_group=False, chatroom__participants=instance
+        ).exclude(user=instance).values_list('user_id', flat=True)
+    )
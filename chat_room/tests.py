@@ -0,0 +1,924 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+from datetime import timedelta
+import redis
+from unittest import mock
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connections
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from Django_Chat.redis_client import get_async_redis
+from Django_Chat.testing import FakeRedisMixin, cache_members, make_user
+from user_api.models import User
+from . import dispatcher, membership, message_writer, retention, sidebar_cache, typing_indicator
+from .models import ChatRoom, Message, Notification, ReadWatermark
+from .serializers.message_serializers import MessageSerializer
+from .pagination import ChatCursorPagination, MessageSearchPagination
+from .routing import websocket_urlpatterns
+from .views import NotificationViewSet
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+def make_room(members, **kwargs):
+    room = ChatRoom.objects.create(creator=members[0], **kwargs)
+    room.participants.set(members)
+    return room
+
+
+def statements(queries):
+    # Queries minus transaction control, which depends on the backend and on whether a test runs in a transaction
+    return [
+        query["sql"] for query in queries
+        if not query["sql"].upper().startswith(("BEGIN", "COMMIT", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK"))
+    ]
+
+
+async def connect(path, user):
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect(timeout=30)
+    assert connected, path
+    return communicator
+
+
+# Sidebar events of a message go to the room's members only
+class SidebarFanOutTests(FakeRedisMixin, TestCase):
+
+    def sidebar_groups_for_message(self, room_size, bystanders):
+        members = [make_user(f"member{room_size}_{i}") for i in range(room_size)]
+        for i in range(bystanders):
+            make_user(f"bystander{room_size}_{i}")
+        room = make_room(members)
+
+        channel_layer = get_channel_layer()
+        with mock.patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            response = client_for(members[0]).post(
+                f"/api/chatrooms/{room.id}/messages/", {"content": "hello"}, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        return sorted(call.args[0] for call in group_send.call_args_list if call.args[0].startswith("sidebar"))
+
+    def test_fan_out_follows_room_size(self):
+        self.assertEqual(len(self.sidebar_groups_for_message(room_size=3, bystanders=0)), 3)
+        self.assertEqual(len(self.sidebar_groups_for_message(room_size=10, bystanders=0)), 10)
+
+    def test_fan_out_ignores_other_users(self):
+        groups = self.sidebar_groups_for_message(room_size=3, bystanders=50)
+        members = ChatRoom.objects.get().participants.values_list('id', flat=True)
+        self.assertEqual(groups, sorted(f"sidebar_{user_id}" for user_id in members))
+
+
+# Consumers only talk to redis through the asyncio client
+class ConsumerLoopLagTests(FakeRedisMixin, TestCase):
+    SYNC_REDIS_DELAY = 0.02
+
+    def slow_sync_redis(self):
+        # Every call of the blocking client takes a network round trip's time, on the
+        # event loop that would stall every socket of the worker
+        def delayed(method):
+            def call(*args, **kwargs):
+                time.sleep(self.SYNC_REDIS_DELAY)
+                return method(*args, **kwargs)
+            return call
+        return (
+            mock.patch.object(redis.Redis, "execute_command", delayed(redis.Redis.execute_command)),
+            mock.patch.object(redis.client.Pipeline, "execute", delayed(redis.client.Pipeline.execute)),
+        )
+
+    async def measure_lag(self, work):
+        # Longest delay of a 10ms ticker while the work runs
+        lags = []
+
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - start - 0.01)
+
+        task = asyncio.create_task(ticker())
+        try:
+            result = await work
+        finally:
+            task.cancel()
+        return max(lags, default=0), result
+
+    async def test_loop_lag_is_bounded_under_1k_connects(self):
+        users = [await User.objects.acreate(username=f"user{i}", email=f"user{i}@example.com") for i in range(1000)]
+        room_members = users[:100]
+        room = await ChatRoom.objects.acreate(creator=users[0])
+        await room.participants.aset(room_members)
+
+        patches = self.slow_sync_redis()
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # Sidebar sockets for everyone, chat sockets for the room's members, all at once
+        lag, communicators = await self.measure_lag(asyncio.gather(
+            *(connect("/ws/sidebar/", user) for user in users),
+            *(connect(f"/ws/chat/{room.id}/", user) for user in room_members),
+        ))
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+        # Scheduling 1100 handshakes at once costs well under a second of loop time, a
+        # single blocking redis call per sidebar connect would add 1000 x 20ms on top
+        self.assertLess(lag, 3.0)
+
+
+# A burst of read receipts is coalesced into one watermark write and one event
+@override_settings(READ_RECEIPT_WINDOW=0.05)
+class ReadReceiptCoalescingTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reader, self.sender = make_user("reader"), make_user("sender")
+        self.room = make_room([self.reader, self.sender])
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room, sender=self.sender, content=f"message {i}") for i in range(100)
+        ])
+
+    async def send_receipts(self, queries, group_send):
+        reader = await connect(f"/ws/chat/{self.room.id}/", self.reader)
+        sender = await connect(f"/ws/chat/{self.room.id}/", self.sender)
+        queries_before, sends_before = len(queries.connection.queries), group_send.call_count
+
+        for message in self.messages:
+            await reader.send_json_to({"type": "read_message", "message_id": message.id})
+        event = await sender.receive_json_from(timeout=5)
+        self.assertTrue(await sender.receive_nothing(0.2))
+
+        operations = (len(queries.connection.queries) - queries_before, group_send.call_count - sends_before)
+        await reader.disconnect()
+        await sender.disconnect()
+        return event, operations
+
+    def test_operations_per_100_receipts(self):
+        channel_layer = get_channel_layer()
+        # The wrapper of this thread, the consumers' queries run here while their loop runs in another one
+        with CaptureQueriesContext(connections["default"]) as queries, \
+                mock.patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            event, (query_count, send_count) = async_to_sync(self.send_receipts)(queries, group_send)
+
+        self.assertEqual(event["type"], "message.read")
+        self.assertEqual(event["message_id"], self.messages[-1].id)
+        # Clamp to the newest message, update the watermark, and as there's none yet create it:
+        # select, then insert in a savepoint
+        self.assertEqual(query_count, 6)
+        self.assertEqual(send_count, 1)
+        self.assertEqual(ReadWatermark.objects.get(user=self.reader).last_read_id, self.messages[-1].id)
+
+
+# Watermarks only move forward, whoever creates the row
+class ReadWatermarkAdvanceTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reader, self.sender = make_user("reader"), make_user("sender")
+        self.room = make_room([self.reader, self.sender])
+
+    def watermark(self):
+        return ReadWatermark.objects.get(room=self.room, user=self.reader).last_read_id
+
+    def test_moves_forward_only(self):
+        self.assertTrue(ReadWatermark.advance(self.room.id, self.reader.id, 10))
+        self.assertTrue(ReadWatermark.advance(self.room.id, self.reader.id, 20))
+        self.assertFalse(ReadWatermark.advance(self.room.id, self.reader.id, 15))
+        self.assertFalse(ReadWatermark.advance(self.room.id, self.reader.id, 20))
+        self.assertEqual(self.watermark(), 20)
+
+    def test_concurrent_first_advance_keeps_the_higher_id(self):
+        get_or_create = ReadWatermark.objects.get_or_create
+
+        def created_meanwhile(**kwargs):
+            # Another request's first advance, to a lower message, wins the insert
+            ReadWatermark.objects.create(room=self.room, user=self.reader, last_read_id=10)
+            return get_or_create(**kwargs)
+
+        with mock.patch.object(ReadWatermark.objects, "get_or_create", created_meanwhile):
+            self.assertTrue(ReadWatermark.advance(self.room.id, self.reader.id, 20))
+        self.assertEqual(self.watermark(), 20)
+
+
+# The typing broadcast lock of a room is only released by the socket that holds it
+class TypingBroadcastLockTests(FakeRedisMixin, TestCase):
+
+    async def test_release_keeps_another_sockets_lock(self):
+        first = await typing_indicator.claim_broadcast(1)
+        self.assertIsNone(await typing_indicator.claim_broadcast(1))
+
+        # The first lock expires and another socket claims the room before the first one releases
+        await get_async_redis().delete(typing_indicator.typing_broadcast_key(1))
+        second = await typing_indicator.claim_broadcast(1)
+        await typing_indicator.release_broadcast(1, first)
+        self.assertIsNone(await typing_indicator.claim_broadcast(1))
+
+        await typing_indicator.release_broadcast(1, second)
+        self.assertIsNotNone(await typing_indicator.claim_broadcast(1))
+
+
+# Typing state over chat sockets: one refresh per throttle interval across a user's
+# sockets, and no broadcast left behind by a closed socket
+class TypingSocketTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.friend = make_user("me"), make_user("friend")
+        self.room = make_room([self.user, self.friend])
+        cache_members(self.room)
+
+    def test_sockets_of_one_user_share_the_throttle(self):
+        async def type_on_two_tabs():
+            first = await connect(f"/ws/chat/{self.room.id}/", self.user)
+            second = await connect(f"/ws/chat/{self.room.id}/", self.user)
+            for tab, frame in ((first, "typing"), (second, "typing"), (first, "stop_typing"), (first, "typing")):
+                await tab.send_json_to({"type": frame})
+                await asyncio.sleep(0.05)
+            users = await typing_indicator.typing_users(self.room.id)
+            await asyncio.gather(first.disconnect(), second.disconnect())
+            return users
+
+        with mock.patch.object(typing_indicator, "set_typing", wraps=typing_indicator.set_typing) as set_typing:
+            users = async_to_sync(type_on_two_tabs)()
+        self.assertEqual(users, ["me"])
+        # The second tab's frame came within the first one's throttle, stopping lets the next one through
+        self.assertEqual([call.args[2] for call in set_typing.call_args_list[:3]], [True, False, True])
+
+    @override_settings(TYPING_BROADCAST_INTERVAL=0.2)
+    def test_pending_broadcast_is_sent_on_disconnect(self):
+        async def type_and_leave():
+            friend = await connect(f"/ws/chat/{self.room.id}/", self.friend)
+            socket = await connect(f"/ws/chat/{self.room.id}/", self.user)
+            await socket.send_json_to({"type": "typing"})
+            await asyncio.sleep(0.05)
+            await socket.disconnect()
+            # Sooner than the interval, and nothing from the closed socket after it
+            update = await friend.receive_json_from(timeout=0.1)
+            quiet = await friend.receive_nothing(timeout=0.4)
+            await friend.disconnect()
+            return update, quiet
+
+        update, quiet = async_to_sync(type_and_leave)()
+        self.assertEqual(update, {"type": "typing_update", "users": []})
+        self.assertTrue(quiet)
+        self.assertIsNotNone(async_to_sync(typing_indicator.claim_broadcast)(self.room.id))
+
+
+# Socket messages arriving together are inserted together, a failed batch is retried one by one
+@override_settings(MESSAGE_BATCH_WINDOW=0.05)
+class MessageWriterTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(3)]
+        self.rooms = [make_room(self.members), make_room(self.members[:2])]
+
+    async def submit_all(self, contents, persist):
+        writer = message_writer.MessageWriter()
+        try:
+            with mock.patch.object(message_writer, "persist_messages", side_effect=persist) as persisted:
+                results = await asyncio.gather(*(
+                    writer.submit(self.rooms[i % 2].id, self.members[0], content) for i, content in enumerate(contents)
+                ), return_exceptions=True)
+        finally:
+            writer._task.cancel()
+        return results, persisted.call_count
+
+    async def test_messages_of_all_rooms_are_inserted_together(self):
+        results, calls = await self.submit_all([f"message {i}" for i in range(20)], message_writer.persist_messages)
+        self.assertEqual(calls, 1)
+        self.assertEqual([payload["content"] for payload in results], [f"message {i}" for i in range(20)])
+        self.assertEqual(await Message.objects.filter(id__in=[payload["id"] for payload in results]).acount(), 20)
+
+    async def test_failed_batch_is_retried_one_by_one(self):
+        persist_messages = message_writer.persist_messages
+
+        def fails_on_bad_rows(messages):
+            if any(message.content == "bad" for message in messages):
+                raise ValueError("bad row")
+            return persist_messages(messages)
+
+        results, calls = await self.submit_all(["first", "bad", "last"], fails_on_bad_rows)
+        # The batch, then each of its three messages
+        self.assertEqual(calls, 4)
+        self.assertEqual(results[0]["content"], "first")
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2]["content"], "last")
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+# Writing a message costs its insert and one update of the room
+class MessageWriteCostTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(3)]
+        self.room = make_room(self.members)
+
+    def test_message_save_costs_two_statements(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            message = Message.objects.create(room=self.room, sender=self.members[0], content="hello")
+
+        sql = statements(queries.captured_queries)
+        self.assertEqual(len(sql), 2, sql)
+        self.assertTrue(sql[0].startswith('INSERT INTO "chat_room_message"'))
+        self.assertTrue(sql[1].startswith('UPDATE "chat_room_chatroom"'))
+
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message, message)
+        self.assertEqual(self.room.last_activity_at, message.timestamp)
+
+    def test_message_save_runs_in_one_transaction(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            Message.objects.create(room=self.room, sender=self.members[0], content="hello")
+        # Inside the test's transaction the atomic block shows up as a savepoint around both statements
+        sql = [query["sql"] for query in queries.captured_queries]
+        self.assertTrue(sql[0].startswith("SAVEPOINT"))
+        self.assertTrue(sql[-1].startswith("RELEASE SAVEPOINT"))
+
+    def test_older_message_does_not_move_the_room_back(self):
+        older = Message.objects.create(room=self.room, sender=self.members[0], content="older")
+        newer = Message.objects.create(room=self.room, sender=self.members[1], content="newer")
+        # The older message's writer commits last
+        ChatRoom.update_last_message(older)
+
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message, newer)
+        self.assertEqual(self.room.last_activity_at, newer.timestamp)
+
+
+# The chat list renders a page in a fixed number of queries
+class ChatListQueryCountTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        for i in range(20):
+            friend = make_user(f"friend{i}")
+            room = make_room([self.user, friend])
+            Message.objects.create(room=room, sender=friend, content=f"hi {i}")
+            group = make_room([self.user, friend, make_user(f"guest{i}")], is_group=True, room_name=f"group {i}")
+            Message.objects.create(room=group, sender=self.user, content=f"hello {i}")
+
+    def assert_list_queries(self, page_size):
+        # A cold list: the snapshot would otherwise serve it without queries
+        sidebar_cache.invalidate_snapshots([self.user.id])
+        with mock.patch.object(ChatCursorPagination, "page_size", page_size):
+            # The rooms with last messages and senders, then the other participant of every room
+            with self.assertNumQueries(2):
+                response = client_for(self.user).get("/api/chatrooms/")
+        self.assertEqual(len(response.data["results"]), page_size)
+        self.assertTrue(all(room["chat_name"] for room in response.data["results"]))
+
+    def test_query_count_is_independent_of_page_size(self):
+        for page_size in (5, 35):
+            with self.subTest(page_size=page_size):
+                self.assert_list_queries(page_size)
+
+
+# The first chat list page is served from a snapshot that new messages patch and edits drop
+class SidebarSnapshotTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        self.friends = [make_user(f"friend{i}") for i in range(3)]
+        self.rooms = [make_room([self.user, friend]) for friend in self.friends]
+        for room, friend in zip(self.rooms, self.friends):
+            Message.objects.create(room=room, sender=friend, content=f"hi from {friend.username}")
+        self.client = client_for(self.user)
+
+    def list_rooms(self):
+        response = self.client.get("/api/chatrooms/")
+        self.assertEqual(response.status_code, 200)
+        return response.data["results"]
+
+    @override_settings(SIDEBAR_STATS_FLUSH_EVERY=1)
+    def test_warm_list_costs_no_queries(self):
+        cold = self.list_rooms()
+        with self.assertNumQueries(0):
+            warm = self.list_rooms()
+        self.assertEqual(warm, cold)
+        # Counts go out on the next request's pipeline
+        self.assertEqual(sidebar_cache.snapshot_stats(), {"hits": 0, "misses": 1, "hit_rate": 0.0})
+        self.list_rooms()
+        self.assertEqual(sidebar_cache.snapshot_stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+        out = StringIO()
+        call_command("cache_stats", "--reset", stdout=out)
+        self.assertIn("1 hits, 1 misses, hit rate 50.0%", out.getvalue())
+        self.assertEqual(sidebar_cache.snapshot_stats()["hits"], 0)
+
+    def test_new_message_patches_the_snapshot(self):
+        self.list_rooms()
+        room, friend = self.rooms[0], self.friends[0]
+        message = Message.objects.create(room=room, sender=friend, content="one more")
+        sidebar_cache.apply_new_messages([message], {room.id: [self.user.id, friend.id]})
+
+        with self.assertNumQueries(0):
+            rooms = self.list_rooms()
+        self.assertEqual(rooms[0]["id"], room.id)
+        self.assertEqual(rooms[0]["last_message"]["id"], message.id)
+        self.assertEqual(rooms[0]["unread_count"], 2)
+
+    def test_edited_message_drops_the_snapshots(self):
+        self.list_rooms()
+        message = self.rooms[0].messages.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            message.content = "edited"
+            message.save()
+
+        self.assertIsNone(sidebar_cache.load_snapshot(self.user.id)[0])
+        self.assertEqual(self.list_rooms()[-1]["last_message"]["content"], "edited")
+
+
+# Cursor pages of the chat list seek on the ordering instead of offsetting
+class KeysetPaginationTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        friend = make_user("friend")
+        now = timezone.now()
+        names = ["beta", "alpha", None, "beta", "gamma", None, "alpha", "delta", None, "beta", "epsilon", "zeta"]
+        for i, name in enumerate(names):
+            room = make_room([self.user, friend], is_group=name is not None, room_name=name)
+            # Pairs of rooms share their activity time, the id breaks the tie
+            ChatRoom.objects.filter(id=room.id).update(last_activity_at=now - timedelta(minutes=i // 2))
+        self.client = client_for(self.user)
+        patch = mock.patch.object(ChatCursorPagination, "page_size", 5)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def walk(self, url, link):
+        # Follows next or previous links from the url, returns the room ids of every page
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([room["id"] for room in response.data["results"]])
+            url = response.data[link]
+        return pages
+
+    def test_next_and_previous_round_trip(self):
+        expected = list(ChatRoom.objects.order_by('-last_activity_at', '-id').values_list('id', flat=True))
+        pages = self.walk("/api/chatrooms/", "next")
+        self.assertEqual([room_id for page in pages for room_id in page], expected)
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+
+        # Back from the last page through previous links gives the same pages
+        last_page = self.client.get("/api/chatrooms/")
+        for _ in range(len(pages) - 1):
+            last_page = self.client.get(last_page.data["next"])
+        self.assertEqual(self.walk(last_page.data["previous"], "previous"), pages[-2::-1])
+
+    def test_room_name_ordering_round_trip(self):
+        # Nulls sort last going forward on every database, the id breaks ties
+        rooms = ChatRoom.objects.values_list('room_name', 'id')
+        expected = [room_id for _, room_id in sorted(rooms, key=lambda room: (room[0] is None, room[0] or "", room[1]))]
+        pages = self.walk("/api/chatrooms/?ordering=room_name", "next")
+        self.assertEqual([room_id for page in pages for room_id in page], expected)
+
+        last_page = self.client.get("/api/chatrooms/?ordering=room_name")
+        for _ in range(len(pages) - 1):
+            last_page = self.client.get(last_page.data["next"])
+        self.assertEqual(self.walk(last_page.data["previous"], "previous"), pages[-2::-1])
+
+    def test_next_page_seeks_on_the_ordering(self):
+        first_page = self.client.get("/api/chatrooms/")
+        with CaptureQueriesContext(connections["default"]) as queries:
+            self.client.get(first_page.data["next"])
+        page_query = next(query["sql"] for query in queries.captured_queries if 'FROM "chat_room_chatroom"' in query["sql"])
+
+        # (last_activity_at, id) < position, bounded on the leading column, page size plus one row, no offset
+        self.assertIn('"chat_room_chatroom"."last_activity_at" <', page_query)
+        self.assertIn('"chat_room_chatroom"."id" <', page_query)
+        self.assertIn('"chat_room_chatroom"."last_activity_at" <=', page_query)
+        self.assertIn("LIMIT 6", page_query)
+        self.assertNotIn("OFFSET", page_query)
+
+    def test_seek_uses_the_activity_index(self):
+        connection = connections["default"]
+        if connection.vendor == "postgresql":
+            # A test sized table is cheaper to scan, make the planner show whether the index can serve the seek
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        position = ChatRoom.objects.order_by('-last_activity_at', '-id')[4]
+        plan = ChatRoom.objects.filter(
+            Q(last_activity_at__lt=position.last_activity_at)
+            | Q(last_activity_at=position.last_activity_at, id__lt=position.id),
+            last_activity_at__lte=position.last_activity_at,
+        ).order_by('-last_activity_at', '-id')[:6].explain()
+        self.assertIn("chatroom_activity_idx", plan)
+
+
+
+# Receipt modes trade read status detail for queries and payload size
+class MessageReceiptModeTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(50)]
+        self.room = make_room(self.members, is_group=True, room_name="everyone")
+        for i in range(20):
+            Message.objects.create(room=self.room, sender=self.members[i % 5], content=f"message {i}")
+        self.client = client_for(self.members[0])
+        cache_members(self.room)
+
+    def get_messages(self, receipts):
+        return self.client.get(f"/api/chatrooms/{self.room.id}/messages/?receipts={receipts}")
+
+    def read_everything(self, readers):
+        last_id = Message.objects.latest('id').id
+        ReadWatermark.objects.all().delete()
+        ReadWatermark.objects.bulk_create(
+            ReadWatermark(room=self.room, user=member, last_read_id=last_id) for member in self.members[:readers]
+        )
+
+    def payload_sizes(self, readers):
+        self.read_everything(readers)
+        return {receipts: len(self.get_messages(receipts).content) for receipts in MessageSerializer.RECEIPT_MODES}
+
+    def test_query_count_per_mode(self):
+        self.read_everything(50)
+        # The page with senders, plus the room's watermarks unless receipts are left out
+        for receipts, expected in (("ids", 2), ("count", 2), ("none", 1)):
+            with self.subTest(receipts=receipts), self.assertNumQueries(expected):
+                response = self.get_messages(receipts)
+            self.assertEqual(len(response.data["results"]), 20)
+
+    def test_cold_membership_costs_one_query(self):
+        self.read_everything(50)
+        membership.invalidate_members([self.room.id])
+        with self.assertNumQueries(3):
+            self.get_messages("ids")
+
+    def test_payload_size_per_mode(self):
+        few, many = self.payload_sizes(readers=5), self.payload_sizes(readers=50)
+        # 20 messages with 45 more readers each: ids grow by every reader id and its comma,
+        # the count by a digit at most, none not at all
+        self.assertGreater(many["ids"] - few["ids"], 20 * 45 * 2)
+        self.assertLessEqual(many["count"] - few["count"], 20)
+        self.assertEqual(many["none"], few["none"])
+        self.assertLess(many["count"], many["ids"] / 2)
+        self.assertLess(many["none"], many["count"])
+
+
+# Message search ranks, highlights, scopes and pages hits through the search index
+class MessageSearchTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.friend, self.stranger = make_user("me"), make_user("friend"), make_user("stranger")
+        self.room = make_room([self.user, self.friend])
+        self.other_room = make_room([self.user, self.friend, self.stranger], is_group=True, room_name="group")
+        self.strangers_room = make_room([self.friend, self.stranger])
+
+        def send(room, content):
+            return Message.objects.create(room=room, sender=self.friend, content=content)
+
+        self.repeated = send(self.room, "apple apple apple")
+        self.long = send(self.room, "apple banana cherry date elderberry fig grape")
+        self.markup = send(self.room, '<b>apple</b> & "pie"')
+        self.typed_markers = send(self.room, "\x02fake\x03 apple")
+        send(self.other_room, "apple in another room")
+        send(self.strangers_room, "apple secret")
+        # Words in only a few messages, so they rank like they would in a real index
+        for i in range(10):
+            send(self.other_room, f"filler {i}")
+        self.client = client_for(self.user)
+
+    def search(self, query, room=None):
+        room = room or self.room
+        response = self.client.get(f"/api/chatrooms/{room.id}/messages/search/", {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return response.data["results"]
+
+    def highlight(self, message):
+        return next(hit["highlight"] for hit in self.search("apple") if hit["id"] == message.id)
+
+    def test_more_matches_rank_first(self):
+        hits = self.search("apple")
+        self.assertEqual(hits[0]["id"], self.repeated.id)
+        ranks = [hit["rank"] for hit in hits]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_markup_is_escaped(self):
+        highlight = self.highlight(self.markup)
+        self.assertIn("<mark>apple</mark>", highlight)
+        self.assertNotIn("<b>", highlight)
+        self.assertIn("&lt;b&gt;", highlight)
+        self.assertIn("&amp;", highlight)
+
+    def test_typed_markers_are_not_matches(self):
+        self.assertEqual(self.highlight(self.typed_markers), "fake <mark>apple</mark>")
+
+    def test_hits_are_scoped_to_the_room(self):
+        self.assertEqual(
+            {hit["id"] for hit in self.search("apple")},
+            {self.repeated.id, self.long.id, self.markup.id, self.typed_markers.id},
+        )
+        self.assertEqual(self.search("secret"), [])
+        response = self.client.get(f"/api/chatrooms/{self.strangers_room.id}/messages/search/", {"q": "secret"})
+        self.assertEqual(response.status_code, 403)
+
+    def test_pages_follow_the_ranking(self):
+        expected = [hit["id"] for hit in self.search("apple")]
+        pages = []
+        with mock.patch.object(MessageSearchPagination, "page_size", 3):
+            url = f"/api/chatrooms/{self.room.id}/messages/search/?q=apple"
+            while url:
+                response = self.client.get(url)
+                pages.append([hit["id"] for hit in response.data["results"]])
+                url = response.data["next"]
+        self.assertEqual([len(page) for page in pages], [3, 1])
+        self.assertEqual([message_id for page in pages for message_id in page], expected)
+
+    def test_index_follows_edits_and_deletes(self):
+        self.long.content = "orange"
+        self.long.save()
+        self.assertEqual([hit["id"] for hit in self.search("orange")], [self.long.id])
+        self.assertNotIn(self.long.id, [hit["id"] for hit in self.search("banana")])
+
+        self.long.delete()
+        self.assertEqual(self.search("orange"), [])
+
+
+# Global search ranks the hits of all the user's rooms together and groups each page by room
+class GlobalSearchTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.friend = make_user("me"), make_user("friend")
+        self.rooms = [make_room([self.user, self.friend]) for _ in range(2)]
+        self.strangers_room = make_room([self.friend, make_user("stranger")])
+        for room, count in ((self.rooms[0], 3), (self.rooms[1], 2), (self.strangers_room, 2)):
+            for i in range(count):
+                Message.objects.create(room=room, sender=self.friend, content=f"apple {i}")
+        Message.objects.create(room=self.rooms[0], sender=self.friend, content="banana")
+        self.client = client_for(self.user)
+
+    def search_pages(self, page_size):
+        pages = []
+        with mock.patch.object(MessageSearchPagination, "page_size", page_size):
+            url = "/api/chatrooms/search/?q=apple"
+            while url:
+                # The hits, the room totals, the rooms and their other participants
+                with self.assertNumQueries(4):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                pages.append(response.data["results"])
+                url = response.data["next"]
+        return pages
+
+    def test_query_count_is_independent_of_page_size(self):
+        for page_size in (2, 35):
+            with self.subTest(page_size=page_size):
+                self.search_pages(page_size)
+
+    def test_hits_are_grouped_by_room_with_totals(self):
+        totals = {self.rooms[0].id: 3, self.rooms[1].id: 2}
+        hits = {}
+        for page in self.search_pages(2):
+            for group in page:
+                room_id = group["room"]["id"]
+                # Totals count every hit in the room, not just the ones on the page
+                self.assertEqual(group["hit_count"], totals[room_id])
+                self.assertTrue(all(hit["room"] == room_id for hit in group["hits"]))
+                hits.setdefault(room_id, []).extend(hit["id"] for hit in group["hits"])
+
+        self.assertEqual({room_id: len(ids) for room_id, ids in hits.items()}, totals)
+        self.assertEqual(sum(len(set(ids)) for ids in hits.values()), 5)
+
+    def test_groups_follow_their_best_hit(self):
+        page, = self.search_pages(35)
+        best = [max(hit["rank"] for hit in group["hits"]) for group in page]
+        self.assertEqual(best, sorted(best, reverse=True))
+
+
+# Membership checks of message requests and chat sockets read the cached member set
+class MembershipQueryCountTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.members = [make_user(f"member{i}") for i in range(30)]
+        self.outsider = make_user("outsider")
+        self.room = make_room(self.members, is_group=True, room_name="everyone")
+        for i in range(10):
+            Message.objects.create(room=self.room, sender=self.members[i % 3], content=f"message {i}")
+        cache_members(self.room)
+
+    def assert_no_participant_queries(self, queries):
+        sql = statements(queries.captured_queries)
+        self.assertFalse([query for query in sql if "chat_room_chatroom_participants" in query], sql)
+
+    def test_message_list_skips_participants(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = client_for(self.members[0]).get(f"/api/chatrooms/{self.room.id}/messages/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 10)
+        self.assert_no_participant_queries(queries)
+
+    def test_message_create_skips_participants(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = client_for(self.members[0]).post(
+                f"/api/chatrooms/{self.room.id}/messages/", {"content": "hello"}, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assert_no_participant_queries(queries)
+
+    def test_outsider_is_refused_without_queries(self):
+        client = client_for(self.outsider)
+        with self.assertNumQueries(0):
+            listed = client.get(f"/api/chatrooms/{self.room.id}/messages/")
+            created = client.post(f"/api/chatrooms/{self.room.id}/messages/", {"content": "hello"}, format="json")
+        self.assertEqual(listed.status_code, 403)
+        self.assertEqual(created.status_code, 403)
+        self.assertFalse(Message.objects.filter(sender=self.outsider).exists())
+
+    def test_connects_cost_no_queries(self):
+        async def connect_members():
+            communicators = await asyncio.gather(
+                *(connect(f"/ws/chat/{self.room.id}/", member) for member in self.members)
+            )
+            await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+        # 30 connects are bounded by redis round trips, not by database queries
+        with self.assertNumQueries(0):
+            async_to_sync(connect_members)()
+
+
+# Old read notifications are deleted in batches, optionally archived first
+class NotificationPruneTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        self.room = make_room([self.user, make_user("friend")], is_group=False)
+        old = timezone.now() - timedelta(days=40)
+        notifications = Notification.objects.bulk_create(
+            [Notification(user=self.user, room=self.room, is_read=True, notification_type='mention')
+             for _ in range(5)]
+            + [Notification(user=self.user, room=self.room, is_read=False, notification_type='mention'),
+               Notification(user=self.user, room=self.room, is_read=True, notification_type='mention')]
+        )
+        # timestamp is set on insert, only the first six are old
+        Notification.objects.filter(id__in=[n.id for n in notifications[:6]]).update(timestamp=old)
+        self.expired_ids = {n.id for n in notifications[:5]}
+        self.kept_ids = {n.id for n in notifications[5:]}
+
+    def test_prunes_expired_rows_in_batches(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            self.assertEqual(retention.prune_notifications(retention_days=30, batch_size=2), 5)
+        # Batches of 2, 2 and 1, the short one ends the run
+        deletes = [sql for sql in statements(queries.captured_queries) if sql.upper().startswith("DELETE")]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(set(Notification.objects.values_list('id', flat=True)), self.kept_ids)
+
+        self.assertEqual(retention.prune_notifications(retention_days=30, batch_size=2), 0)
+
+    def test_archive_is_gzipped_ndjson(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive = os.path.join(directory, "notifications.ndjson.gz")
+            call_command(
+                "prune_notifications", "--days", "30", "--batch-size", "2", "--archive", archive, stdout=StringIO()
+            )
+            # A later run appends another gzip member to the same file
+            Notification.objects.filter(id__in=self.kept_ids).update(
+                is_read=True, timestamp=timezone.now() - timedelta(days=40)
+            )
+            retention.prune_notifications(retention_days=30, archive=archive)
+
+            with gzip.open(archive, "rt", encoding="utf-8") as file:
+                rows = [json.loads(line) for line in file]
+        self.assertEqual([row["id"] for row in rows[:5]], sorted(self.expired_ids))
+        self.assertEqual({row["id"] for row in rows[5:]}, self.kept_ids)
+        self.assertEqual(rows[0]["user_id"], self.user.id)
+        self.assertEqual(rows[0]["room_id"], self.room.id)
+        self.assertTrue(rows[0]["is_read"])
+        self.assertFalse(Notification.objects.exists())
+
+
+# New messages count into one unread notification per user and room
+class NotificationDispatchTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ann, self.bob, self.cat = make_user("ann"), make_user("bob"), make_user("cat")
+        self.room = make_room([self.ann, self.bob, self.cat], is_group=True, room_name="everyone")
+        self.members = {self.room.id: [self.ann.id, self.bob.id, self.cat.id]}
+
+    def send(self, sender, count=1):
+        return [Message.objects.create(room=self.room, sender=sender, content=f"hi {i}") for i in range(count)]
+
+    def dispatch(self, messages):
+        events = dispatcher.create_notifications(messages, self.members)
+        return {group: event["message"]["count"] for group, event in events}
+
+    def rows(self, user):
+        return list(Notification.objects.filter(user=user).order_by('id').values_list('is_read', 'count'))
+
+    def test_messages_collapse_per_user_and_room(self):
+        first, second = self.send(self.ann, 2)
+        third, = self.send(self.bob)
+        counts = self.dispatch([first, second, third])
+
+        self.assertEqual(counts, {f"notification_{self.ann.id}": 1, f"notification_{self.bob.id}": 2,
+                                  f"notification_{self.cat.id}": 3})
+        self.assertEqual(
+            {n.user_id: (n.count, n.message_id) for n in Notification.objects.all()},
+            {self.ann.id: (1, third.id), self.bob.id: (2, second.id), self.cat.id: (3, third.id)},
+        )
+
+    def test_unread_notification_keeps_counting(self):
+        self.dispatch(self.send(self.ann))
+        counts = self.dispatch(self.send(self.ann))
+        self.assertEqual(counts[f"notification_{self.bob.id}"], 2)
+        self.assertEqual(self.rows(self.bob), [(False, 2)])
+
+    def test_read_notification_starts_a_new_one(self):
+        self.dispatch(self.send(self.ann))
+        notification = Notification.objects.get(user=self.bob)
+        response = client_for(self.bob).post(f"/api/notifications/{notification.id}/mark_read/")
+        self.assertEqual(response.status_code, 204)
+
+        self.dispatch(self.send(self.ann))
+        self.assertEqual(self.rows(self.bob), [(True, 1), (False, 1)])
+
+    def test_notification_read_before_it_is_locked(self):
+        bulk_create = Notification.objects.bulk_create
+
+        def read_after_first_insert(*args, **kwargs):
+            created = bulk_create(*args, **kwargs)
+            if inserts.call_count == 1:
+                # Marked read between the insert and the locking select, like from another request
+                Notification.objects.filter(user=self.bob).update(is_read=True)
+            return created
+
+        with mock.patch.object(Notification.objects, "bulk_create", side_effect=read_after_first_insert) as inserts:
+            counts = self.dispatch(self.send(self.ann))
+        # Only bob's row is inserted again, and the count goes to the new one
+        self.assertEqual(inserts.call_count, 2)
+        self.assertEqual(len(inserts.call_args_list[1].args[0]), 1)
+        self.assertEqual(counts[f"notification_{self.bob.id}"], 1)
+        self.assertEqual(self.rows(self.bob), [(True, 0), (False, 1)])
+        self.assertEqual(self.rows(self.cat), [(False, 1)])
+
+    def test_is_read_is_not_writable(self):
+        self.dispatch(self.send(self.ann))
+        Notification.objects.filter(user=self.bob).update(is_read=True)
+        self.dispatch(self.send(self.ann))
+        read = Notification.objects.get(user=self.bob, is_read=True)
+
+        # Unreading it would clash with the unread notification of the room
+        response = client_for(self.bob).patch(f"/api/notifications/{read.id}/", {"is_read": False}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data["is_read"])
+        self.assertEqual(self.rows(self.bob), [(True, 1), (False, 1)])
+
+    def test_mark_read_keeps_counts_added_meanwhile(self):
+        self.dispatch(self.send(self.ann))
+        stale = Notification.objects.get(user=self.bob)
+        self.dispatch(self.send(self.ann))
+
+        with mock.patch.object(NotificationViewSet, "get_object", return_value=stale):
+            response = client_for(self.bob).post(f"/api/notifications/{stale.id}/mark_read/")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.rows(self.bob), [(True, 2)])
+
+    def test_socket_mark_read_keeps_counts_added_meanwhile(self):
+        self.dispatch(self.send(self.ann))
+        stale = Notification.objects.get(user=self.bob)
+        self.dispatch(self.send(self.ann))
+
+        async def mark_read_twice():
+            socket = await connect("/ws/notifications/", self.bob)
+            self.assertEqual((await socket.receive_json_from())["type"], "notification_list")
+            responses = []
+            for _ in range(2):
+                await socket.send_json_to({"action": "mark_read", "notification_id": stale.id})
+                responses.append((await socket.receive_json_from())["success"])
+            await socket.disconnect()
+            return responses
+
+        # A row loaded before the second dispatch must not be written back
+        with mock.patch.object(Notification.objects, "get", return_value=stale):
+            responses = async_to_sync(mark_read_twice)()
+        self.assertEqual(responses, [True, False])
+        self.assertEqual(self.rows(self.bob), [(True, 2)])
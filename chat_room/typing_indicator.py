@@ -0,0 +1,86 @@
+import math
+import time
+import uuid
+from django.conf import settings
+from redis.exceptions import WatchError
+from Django_Chat.redis_client import get_async_redis
+
+# Typing state of a room lives in a sorted set of usernames scored with the time
+# their typing state expires, so it is shared by all workers and ages out on its own.
+# A user's state in a room is refreshed at most once per TYPING_THROTTLE, however
+# many sockets the user has open there, and rooms get at most one "who is typing"
+# broadcast per TYPING_BROADCAST_INTERVAL.
+
+
+def typing_key(room_id):
+    return f"room:{room_id}:typing"
+
+
+def typing_throttle_key(room_id, username):
+    return f"room:{room_id}:typing:{username}:throttle"
+
+
+def typing_broadcast_key(room_id):
+    return f"room:{room_id}:typing:broadcast"
+
+
+async def claim_typing_refresh(room_id, username):
+    """
+    Lets one refresh of a user's typing state in a room through per TYPING_THROTTLE,
+    across all the user's sockets. Returns False if another one went through recently.
+    """
+    if settings.TYPING_THROTTLE <= 0:
+        return True
+    return bool(await get_async_redis().set(
+        typing_throttle_key(room_id, username), 1, nx=True, px=int(settings.TYPING_THROTTLE * 1000)
+    ))
+
+
+async def set_typing(room_id, username, is_typing):
+    """Records a user's typing state, returns True if it changed the room's typing list."""
+    now = time.time()
+    key = typing_key(room_id)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        if is_typing:
+            pipe.zadd(key, {username: now + settings.TYPING_TIMEOUT})
+        else:
+            pipe.zrem(key, username)
+            # Typing again right after stopping has to get through
+            pipe.delete(typing_throttle_key(room_id, username))
+        pipe.zremrangebyscore(key, "-inf", now)
+        # Outlives the entries, so a socket's own timeout still finds and removes its entry
+        pipe.expire(key, math.ceil(2 * settings.TYPING_TIMEOUT))
+        changed, *_ = await pipe.execute()
+    return bool(changed)
+
+
+async def claim_broadcast(room_id):
+    """
+    Only the socket that wins this lock, on any worker, schedules the room's next
+    broadcast. Returns the token to release it with, or None if it's taken.
+    """
+    token = uuid.uuid4().hex
+    claimed = await get_async_redis().set(
+        typing_broadcast_key(room_id), token, nx=True, px=int(settings.TYPING_BROADCAST_INTERVAL * 1000)
+    )
+    return token if claimed else None
+
+
+async def release_broadcast(room_id, token):
+    # The lock may have expired and been claimed by another socket, which keeps it
+    key = typing_broadcast_key(room_id)
+    async with get_async_redis().pipeline() as pipe:
+        try:
+            await pipe.watch(key)
+            if await pipe.get(key) == token.encode():
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+        except WatchError:
+            # Changed since the read, so it's someone else's now
+            pass
+
+
+async def typing_users(room_id):
+    members = await get_async_redis().zrangebyscore(typing_key(room_id), time.time(), "+inf")
+    return sorted(member.decode() for member in members)
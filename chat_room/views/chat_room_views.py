@@ -3,23 +3,23 @@ from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
-from ..models import ChatRoom, User
-from django.db.models import F
+from ..models import ChatRoom, Message, ReadWatermark, User
+from django.db.models import Count, F, Prefetch
 from ..permissions import IsRoomAdmin, IsRoomParticipant
 from ..serializers import (
     ChatRoomCreateSerializer, ChatRoomSerializer,
     AddMemberSerializer, RemoveMemberSerializer,
-    ChatRoomListSerializer
+    ChatRoomListSerializer, MessageSearchHitSerializer
     )
-from drf_spectacular.utils import extend_schema, OpenApiResponse
-from rest_framework.exceptions import MethodNotAllowed
+from drf_spectacular.utils import extend_schema, OpenApiResponse, OpenApiParameter
+from rest_framework.exceptions import MethodNotAllowed, ValidationError
 from rest_framework.filters import SearchFilter, OrderingFilter
-from ..pagination import ChatCursorPagination
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from ..pagination import ChatCursorPagination, MessageSearchPagination
+from ..search import rank_messages, search_messages as find_message_hits
+from ..sidebar import broadcast_sidebar_update
+from .. import sidebar_cache
 import json
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models.functions import Coalesce
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
@@ -27,19 +27,43 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
     filter_backends = {SearchFilter, OrderingFilter}
     search_fields = ['room_name', 'participants__username']
     ordering_fields = ['room_name']
-    ordering = ['-sort_time']
+    ordering = ['-last_activity_at', '-id']
     pagination_class = ChatCursorPagination
 
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user).annotate(
-            sort_time=Coalesce('last_message__timestamp', 'created_at')
-        ).order_by('-sort_time')
+        queryset = ChatRoom.objects.filter(participants=self.request.user).annotate(
+            unread_count=ReadWatermark.unread_count_subquery(self.request.user)
+        ).order_by('-last_activity_at', '-id')
+
+        if self.action in ('list', 'search_messages'):
+            # Load everything the list renders in bulk: the last message with its sender
+            # and, per room, the other participant used for private chat names and avatars
+            other_participant = User.objects.exclude(id=self.request.user.id).only(
+                'id', 'username', 'first_name', 'last_name', 'profile_pic'
+            ).order_by('id')[:1]
+            queryset = queryset.select_related('last_message__sender').prefetch_related(
+                Prefetch('participants', queryset=other_participant, to_attr='other_participants')
+            )
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # The plain first page is what every app start asks for, serve it from the user's snapshot
+        if request.query_params:
+            return super().list(request, *args, **kwargs)
+
+        snapshot, version = sidebar_cache.load_snapshot(request.user.id)
+        if snapshot is not None:
+            return Response(snapshot)
+
+        response = super().list(request, *args, **kwargs)
+        sidebar_cache.store_snapshot(request.user.id, version, response.data)
+        return response
 
     def get_serializer_class(self):
         # Use different serializer for creation
         if self.action == 'create':
             return ChatRoomCreateSerializer
-        if self.action == 'list':
+        if self.action in ('list', 'search_messages'):
             return ChatRoomListSerializer
         return ChatRoomSerializer
 
@@ -50,16 +74,12 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         
         json_data = json.dumps(serialized_data, cls=DjangoJSONEncoder)
         safe_data = json.loads(json_data)
-        # Notify all connected sidebar clients
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            "sidebar",
+        # Notify the sidebars of the new room's participants
+        broadcast_sidebar_update(
+            chatroom.participants.values_list("id", flat=True),
             {
-                "type": "group.update",
-                "data": {
-                    "type": "group_created",
-                    "group": safe_data
-                }
+                "type": "group_created",
+                "group": safe_data
             }
         )
     @extend_schema(
@@ -197,3 +217,54 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         # Get the room's shareable link ID
         room = self.get_object()
         return Response({"room_id": room.sharable_room_id})
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='q', description='Words to search for', type=str, required=True)
+        ],
+        responses={200: OpenApiResponse(
+            description="Pages of ranked hits grouped by room: "
+                        "[{room, hit_count, hits}], hit_count counts every hit in the room"
+        )}
+    )
+    @action(detail=False, methods=['get'], url_path='search', pagination_class=MessageSearchPagination,
+            filter_backends=[])
+    def search_messages(self, request):
+        """
+        Searches every conversation of the user at once. Hits are ranked and paginated
+        across rooms, each page groups its hits by room in order of their best hit.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({"q": "This field is required."})
+
+        # The membership semi-join and the search index narrow the messages in one query
+        member_rooms = ChatRoom.participants.through.objects.filter(
+            user=request.user
+        ).values('chatroom_id')
+        hits = self.paginate_queryset(rank_messages(
+            Message.objects.filter(room_id__in=member_rooms).select_related('sender'), query
+        ))
+
+        room_hits = {}
+        for hit in hits:
+            room_hits.setdefault(hit.room_id, []).append(hit)
+
+        # Totals per room cover all hits, not only the ones on this page
+        hit_counts = dict(
+            find_message_hits(Message.objects.filter(room_id__in=room_hits), query)
+            .order_by().values('room_id').annotate(count=Count('id')).values_list('room_id', 'count')
+        )
+        rooms = self.get_queryset().filter(id__in=room_hits).in_bulk()
+
+        context = {**self.get_serializer_context(), 'receipts': 'none'}
+        room_data = ChatRoomListSerializer(list(rooms.values()), many=True, context=context).data
+        room_data = {room['id']: room for room in room_data}
+        return self.get_paginated_response([
+            {
+                "room": room_data[room_id],
+                "hit_count": hit_counts.get(room_id, len(messages)),
+                "hits": MessageSearchHitSerializer(messages, many=True, context=context).data,
+            }
+            for room_id, messages in room_hits.items()
+        ])
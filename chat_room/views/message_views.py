@@ -1,15 +1,25 @@
-from ..serializers import MessageSerializer, MessageCreateSerializer, MessageReadStatusSerializer
+from ..serializers import (
+    MessageSerializer, MessageCreateSerializer, ReadWatermarkSerializer,
+    MessageHistoryParamsSerializer, MessageSearchHitSerializer
+)
 from rest_framework.permissions import IsAuthenticated
-from ..models import Message, MessageReadStatus
+from ..models import ChatRoom, Message, ReadWatermark
+from django.db.models import Q
+from django.shortcuts import get_object_or_404
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework import viewsets
 from ..permissions import IsMessageSender, IsRoomParticipant
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from rest_framework.filters import SearchFilter, OrderingFilter
-from ..pagination import MessageCursorPagination
+from rest_framework.filters import OrderingFilter
+from ..pagination import MessageCursorPagination, MessageSearchPagination
+from ..search import MessageSearchFilter, rank_messages
+from ..sidebar import broadcast_sidebar_update, last_message_update
+from ..sidebar_cache import invalidate_snapshots
+from ..membership import member_ids
 
 # Add chatroom ID parameter for API docs
 @extend_schema(
@@ -26,8 +36,7 @@ class MessageViewSet(viewsets.ModelViewSet):
     # Only authenticated room participants can access messages
     permission_classes = [IsAuthenticated, IsRoomParticipant]
     queryset = Message.objects.all()
-    filter_backends = (SearchFilter, OrderingFilter)
-    search_fields = ['content', 'sender']
+    filter_backends = (MessageSearchFilter, OrderingFilter)
     ordering_fields = ['timestamp', 'id']
     ordering = ['-timestamp', '-id']
     pagination_class = MessageCursorPagination
@@ -36,6 +45,8 @@ class MessageViewSet(viewsets.ModelViewSet):
         # Use create serializer when creating message
         if self.action == 'create':
             return MessageCreateSerializer
+        if self.action == 'search':
+            return MessageSearchHitSerializer
         return MessageSerializer
 
     def get_permissions(self):
@@ -47,7 +58,29 @@ class MessageViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # Return messages for a specific chatroom
         chatroom_id = self.kwargs['chatroom_pk']
-        return Message.objects.filter(room_id=chatroom_id).order_by('-timestamp')
+        return Message.objects.filter(room_id=chatroom_id).select_related('sender').order_by('-timestamp')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        receipts = self.request.query_params.get('receipts', 'ids')
+        if receipts not in MessageSerializer.RECEIPT_MODES:
+            raise ValidationError({"receipts": f"Must be one of {', '.join(MessageSerializer.RECEIPT_MODES)}."})
+        context['receipts'] = receipts
+        return context
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='receipts',
+                description='Read status per message: ids (reader ids and count), count or none',
+                type=str,
+                enum=list(MessageSerializer.RECEIPT_MODES),
+                default='ids'
+            )
+        ]
+    )
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         # Save message and send it via WebSocket
@@ -56,49 +89,30 @@ class MessageViewSet(viewsets.ModelViewSet):
 
         # Notify room for message
         async_to_sync(channel_layer.group_send)(
-            f"chat_{message.room.id}",
+            f"chat_{message.room_id}",
             {
                 "type": "chat.message",
                 "message": MessageSerializer(message).data
             }
         )
 
-        # Notify sidebar to update last message preview
-        async_to_sync(channel_layer.group_send)(
-            "sidebar",
-            {
-                "type": "group.update",
-                "data": {
-                    "type": "last_message_updated",
-                    "group_id": message.room.id,
-                    "last_message": {
-                        "id": message.id,
-                        "text": message.content,
-                        "sender": message.sender.username,
-                        "timestamp": message.timestamp.isoformat()
-                    }
-                }
-            }
-        )
+        # Notify the sidebars of room participants to update last message preview
+        broadcast_sidebar_update(member_ids(message.room_id), last_message_update(message))
 
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated, IsRoomParticipant])
-    def mark_as_read(self, request, pk=None):
-        # Mark a message as read by a user (excluding sender)
+    def mark_as_read(self, request, pk=None, chatroom_pk=None):
+        # Mark every message up to and including this one as read by the user
         message = self.get_object()
-        
-        if message.sender == request.user:
-            return Response({"detail": "Sender cannot mark own message as read"})
-
-        read_status, created = MessageReadStatus.objects.get_or_create(
-            message=message,
-            user=request.user
-        )
+        advanced = ReadWatermark.advance(message.room_id, request.user.id, message.id)
+        watermark = ReadWatermark.objects.get(room_id=message.room_id, user=request.user)
 
-        # Send read status over WebSocket if newly created
-        if created:
+        # Send read status over WebSocket if the watermark moved forward
+        if advanced:
+            # Unread counts in the user's chat list changed
+            invalidate_snapshots([request.user.id])
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
-                f"chatroom_{message.room.id}",
+                f"chat_{message.room_id}",
                 {
                     "type": "message.read",
                     "message_id": message.id,
@@ -106,16 +120,94 @@ class MessageViewSet(viewsets.ModelViewSet):
                         "id": request.user.id,
                         "username": request.user.username,
                     },
-                    "read_at": read_status.timestamp.isoformat()
+                    "read_at": watermark.updated_at.isoformat()
                 }
             )
-        serializer = MessageReadStatusSerializer(read_status)
-        return Response(serializer.data, status=201 if created else 200)
+        serializer = ReadWatermarkSerializer(watermark)
+        return Response(serializer.data, status=201 if advanced else 200)
 
     @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated, IsRoomParticipant])
-    def message_read_status(self, request, pk=None):
-        # Get list of users who read the message
+    def message_read_status(self, request, pk=None, chatroom_pk=None):
+        # Get list of users whose watermark has passed the message
         message = self.get_object()
-        read_statuses = message.readstatuses.select_related('user')
-        serializer = MessageReadStatusSerializer(read_statuses, many=True)
+        watermarks = ReadWatermark.objects.filter(
+            room_id=message.room_id, last_read_id__gte=message.id
+        ).exclude(user_id=message.sender_id).select_related('user')
+        serializer = ReadWatermarkSerializer(watermarks, many=True)
         return Response(serializer.data)
+
+    @extend_schema(
+        parameters=[MessageHistoryParamsSerializer],
+        responses={200: MessageSerializer(many=True)}
+    )
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsRoomParticipant])
+    def history(self, request, chatroom_pk=None):
+        """
+        Messages before, after or around an anchor message, newest first like the message list.
+        has_before/has_after tell whether the client can keep loading from the oldest or newest one.
+        """
+        params = MessageHistoryParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        direction, limit = params.validated_data['direction'], params.validated_data['limit']
+
+        queryset = self.get_queryset()
+        anchor = get_object_or_404(queryset, pk=params.validated_data['anchor'])
+        self.check_object_permissions(request, anchor)
+
+        # Around splits the limit, the anchor takes one of the slots
+        if direction == 'around':
+            before_limit = (limit - 1) // 2
+            after_limit = limit - 1 - before_limit
+        else:
+            before_limit = limit if direction == 'before' else 0
+            after_limit = limit if direction == 'after' else 0
+
+        # One extra row per side tells whether there's more beyond the window
+        older = list(self.seek(queryset, anchor, older=True)[:before_limit + 1]) if before_limit else []
+        newer = list(self.seek(queryset, anchor, older=False)[:after_limit + 1]) if after_limit else []
+
+        messages = newer[:after_limit][::-1]
+        if direction == 'around':
+            messages.append(anchor)
+        messages += older[:before_limit]
+
+        serializer = self.get_serializer(messages, many=True)
+        return Response({
+            "has_before": len(older) > before_limit if before_limit else None,
+            "has_after": len(newer) > after_limit if after_limit else None,
+            "results": serializer.data,
+        })
+
+    @staticmethod
+    def seek(queryset, anchor, older):
+        # Keyset on (timestamp, id) walking away from the anchor, ranged on the (room, timestamp) index
+        if older:
+            return queryset.filter(
+                Q(timestamp__lt=anchor.timestamp) | Q(timestamp=anchor.timestamp, id__lt=anchor.id),
+                timestamp__lte=anchor.timestamp
+            ).order_by('-timestamp', '-id')
+        return queryset.filter(
+            Q(timestamp__gt=anchor.timestamp) | Q(timestamp=anchor.timestamp, id__gt=anchor.id),
+            timestamp__gte=anchor.timestamp
+        ).order_by('timestamp', 'id')
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='q', description='Words to search for', type=str, required=True)
+        ],
+        responses={200: MessageSearchHitSerializer(many=True)}
+    )
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsRoomParticipant],
+            pagination_class=MessageSearchPagination, filter_backends=[])
+    def search(self, request, chatroom_pk=None):
+        # Ranked full text search in the room's messages, most relevant first
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({"q": "This field is required."})
+
+        room = get_object_or_404(ChatRoom, pk=chatroom_pk)
+        self.check_object_permissions(request, room)
+
+        page = self.paginate_queryset(rank_messages(self.get_queryset(), query))
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
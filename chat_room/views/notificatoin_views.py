@@ -38,10 +38,10 @@ class NotificationViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
-        # Mark a specific notification as read
+        # Mark a specific notification as read. Only the flag is written, the row may be
+        # stale and a dispatcher may have added to its count since it was read.
         notification = self.get_object()
-        notification.is_read = True
-        notification.save()
+        Notification.objects.filter(pk=notification.pk, is_read=False).update(is_read=True)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=['post'])
@@ -0,0 +1,19 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from drf_spectacular.contrib.rest_framework_simplejwt import SimpleJWTScheme
+from .identity import get_token_user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that resolves the user through the identity cache.
+    The token itself is still validated locally by simplejwt, signature,
+    expiry, type and blacklist checks included, only the users table lookup is skipped.
+    """
+
+    def get_user(self, validated_token):
+        return get_token_user(validated_token)
+
+
+# Documents the class in the OpenAPI schema like the simplejwt one it extends
+class CachedJWTScheme(SimpleJWTScheme):
+    target_class = 'user_api.authentication.CachedJWTAuthentication'
@@ -0,0 +1,226 @@
+import asyncio
+import random
+import time
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.conf import settings
+from django.db import connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.tokens import AccessToken
+from chat_room.routing import websocket_urlpatterns
+from Django_Chat import middleware
+from Django_Chat.testing import FakeRedisMixin, benchmark_size, count_async_pipelines, make_user, percentile, report
+from . import presence
+from .models import User
+
+
+# Redis write load of presence heartbeats, per 10k open connections
+class PresenceHeartbeatBenchmark(FakeRedisMixin, TestCase):
+    CONNECTIONS = 10000
+    TABS_PER_USER = 2
+
+    def test_heartbeat_write_load(self):
+        connections = benchmark_size(self.CONNECTIONS)
+        users = max(1, connections // self.TABS_PER_USER)
+        sockets = [(i % users + 1, f"socket.{i}") for i in range(connections)]
+
+        async def beat_all():
+            # One heartbeat interval: every connection refreshes once
+            await asyncio.gather(*(presence.heartbeat(user_id, socket) for user_id, socket in sockets))
+
+        counters, patch = count_async_pipelines()
+        with patch, self.assertNumQueries(0):
+            start = time.perf_counter()
+            async_to_sync(beat_all)()
+            elapsed = time.perf_counter() - start
+
+        interval = settings.PRESENCE_HEARTBEAT_INTERVAL
+        report(
+            "heartbeats",
+            connections=connections,
+            round_trips=counters["round_trips"],
+            commands=counters["commands"],
+            commands_per_second=counters["commands"] / interval,
+            redis_keys=get_redis_connection("default").dbsize(),
+            seconds=elapsed,
+        )
+        # One pipelined round trip of three commands per heartbeat, one sorted set per user
+        self.assertEqual(counters["round_trips"], connections)
+        self.assertEqual(counters["commands"], 3 * connections)
+        self.assertEqual(get_redis_connection("default").dbsize(), users)
+        self.assertTrue(all(state.online for state in presence.fetch_presence(range(1, users + 1)).values()))
+
+
+# Directory search latency over a million users, uncached and with the first page cache
+class UserDirectorySearchBenchmark(FakeRedisMixin, TestCase):
+    USERS = 1000000
+    BATCH = 10000
+    REQUESTS = 20
+    SYLLABLES = ["an", "be", "ca", "do", "el", "fi", "go", "ha", "in", "jo", "ka", "li", "mo", "na", "or"]
+    QUERIES = ["a", "an", "ann", "anbe", "ka li"]
+
+    def setUp(self):
+        super().setUp()
+        randomizer = random.Random(0)
+
+        def word():
+            return "".join(randomizer.choices(self.SYLLABLES, k=randomizer.randint(2, 4)))
+
+        total = benchmark_size(self.USERS)
+        for first in range(0, total, self.BATCH):
+            User.objects.bulk_create([
+                # The number keeps usernames unique, unusable passwords skip hashing
+                User(username=f"{word()}{i}", email=f"user{i}@example.com", password="!",
+                     first_name=word().title(), last_name=word().title())
+                for i in range(first, min(first + self.BATCH, total))
+            ])
+        self.client = APIClient()
+        self.client.force_authenticate(make_user("me"))
+
+    def latencies(self, query, pages=1):
+        latencies = []
+        for _ in range(self.REQUESTS):
+            url, params = "/api/users/", {"search": query}
+            for _ in range(pages):
+                start = time.perf_counter()
+                response = self.client.get(url, params)
+                latencies.append(time.perf_counter() - start)
+                self.assertEqual(response.status_code, 200)
+                url, params = response.data["next"], None
+                if not url:
+                    break
+        return latencies
+
+    def test_search_latency(self):
+        for query in self.QUERIES:
+            with override_settings(USER_SEARCH_CACHE_TTL=0):
+                uncached = self.latencies(query)
+                deep = self.latencies(query, pages=10)
+            cached = self.latencies(query)
+            report(
+                f"user search, {query!r}",
+                users=benchmark_size(self.USERS),
+                uncached_p50_ms=percentile(uncached, 0.5) * 1000,
+                uncached_p99_ms=percentile(uncached, 0.99) * 1000,
+                cached_p50_ms=percentile(cached, 0.5) * 1000,
+                ten_pages_p50_ms=percentile(deep, 0.5) * 1000,
+            )
+
+
+# Sidebar socket connects per second with tokens resolved from the users table,
+# like before the identity cache, and through the cache, cold and warm
+class IdentityConnectBenchmark(FakeRedisMixin, TestCase):
+    CONNECTS = 1000
+
+    def setUp(self):
+        super().setUp()
+        users = [make_user(f"user{i}") for i in range(benchmark_size(self.CONNECTS))]
+        self.tokens = [str(AccessToken.for_user(user)) for user in users]
+        self.application = middleware.JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    async def connect_all(self):
+        start = time.perf_counter()
+        sockets = []
+        for token in self.tokens:
+            socket = WebsocketCommunicator(self.application, f"/ws/sidebar/?token={token}")
+            connected, _ = await socket.connect(timeout=30)
+            self.assertTrue(connected)
+            sockets.append(socket)
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*(socket.disconnect() for socket in sockets))
+        return len(sockets) / elapsed
+
+    def measure(self):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            rate = async_to_sync(self.connect_all)()
+        return rate, len(queries.captured_queries)
+
+    def test_connects_per_second(self):
+        async def user_from_database(validated_token):
+            try:
+                return await database_sync_to_async(JWTAuthentication().get_user)(validated_token)
+            except (AuthenticationFailed, InvalidToken):
+                return AnonymousUser()
+
+        with mock.patch.object(middleware, "get_user", user_from_database):
+            database = self.measure()
+        cold = self.measure()
+        warm = self.measure()
+
+        for name, (rate, queries) in (("database", database), ("cold cache", cold), ("warm cache", warm)):
+            report(f"socket connects, {name}", connects=len(self.tokens), per_second=rate, queries=queries)
+        self.assertEqual(database[1], len(self.tokens))
+        self.assertEqual(warm[1], 0)
+
+
+# Users table writes and time of 10k connections opened and closed by 1000
+# users, with last seen saved on every connect and disconnect like before
+# the write-behind flush, and recorded in redis and flushed once
+class PresenceChurnBenchmark(FakeRedisMixin, TestCase):
+    CONNECTIONS = 10000
+    USERS = 1000
+
+    def setUp(self):
+        super().setUp()
+        self.users = [make_user(f"user{i}") for i in range(benchmark_size(self.USERS))]
+        self.sockets = [
+            (self.users[i % len(self.users)].id, f"socket.{i}") for i in range(benchmark_size(self.CONNECTIONS))
+        ]
+
+    def test_churned_connections(self):
+        def save_last_seen(user_id):
+            # The whole user loaded and every column saved
+            user = User.objects.get(id=user_id)
+            user.last_seen = timezone.now()
+            user.save()
+
+        with CaptureQueriesContext(connections["default"]) as per_socket_writes:
+            start = time.perf_counter()
+            for user_id, _ in self.sockets:
+                save_last_seen(user_id)
+                save_last_seen(user_id)
+            per_socket_seconds = time.perf_counter() - start
+
+        async def churn():
+            for user_id, socket in self.sockets:
+                await presence.heartbeat(user_id, socket)
+                await presence.disconnect(user_id, socket, timezone.now())
+
+        with self.assertNumQueries(0):
+            start = time.perf_counter()
+            async_to_sync(churn)()
+            churn_seconds = time.perf_counter() - start
+        with CaptureQueriesContext(connections["default"]) as flush_writes:
+            start = time.perf_counter()
+            flushed = presence.flush_last_seen()
+            flush_seconds = time.perf_counter() - start
+
+        report(
+            "presence churn, per socket saves",
+            connections=len(self.sockets),
+            users_table_statements=len(per_socket_writes.captured_queries),
+            seconds=per_socket_seconds,
+        )
+        report(
+            "presence churn, write-behind",
+            connections=len(self.sockets),
+            users_table_statements=len(flush_writes.captured_queries),
+            churn_seconds=churn_seconds,
+            flush_seconds=flush_seconds,
+        )
+        # One UPDATE per batch of dirty users, however often they reconnected
+        self.assertEqual(flushed, len(self.users))
+        self.assertEqual(
+            len(flush_writes.captured_queries), -(-len(self.users) // settings.PRESENCE_FLUSH_BATCH_SIZE)
+        )
+        self.assertFalse(presence.fetch_presence([self.users[0].id])[self.users[0].id].online)
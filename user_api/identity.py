@@ -0,0 +1,164 @@
+import json
+import threading
+from cachetools import TTLCache
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+from django_redis import get_redis_connection
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from Django_Chat.redis_client import get_async_redis
+from Django_Chat.stats import BatchedCounters
+
+User = get_user_model()
+
+# Token to user resolution without the users table. The columns needed to
+# authenticate a user are cached in redis as JSON under the user's identity
+# version, and in every process on top of that. Saving or deleting a user
+# bumps the version, so a deactivation, password or profile change applies
+# to the next request everywhere: a lookup costs one redis round trip for
+# the version and nothing else while the process has that version cached.
+
+# Columns the cached user is rebuilt from, anything else is loaded on first access
+IDENTITY_FIELDS = (
+    'id', 'username', 'email', 'first_name', 'last_name', 'bio', 'profile_pic',
+    'is_active', 'is_staff', 'is_superuser',
+)
+
+_local = TTLCache(maxsize=settings.IDENTITY_LOCAL_SIZE, ttl=settings.IDENTITY_LOCAL_TTL)
+# cachetools caches aren't thread safe
+_local_lock = threading.Lock()
+
+
+# Lookups and database loads, lookups minus loads is the number of user queries saved.
+# Added to redis every IDENTITY_STATS_FLUSH_EVERY counts.
+_stats = BatchedCounters("identity:stats")
+
+
+def version_key(user_id):
+    return f"user:{user_id}:identity_version"
+
+
+def identity_key(user_id, version):
+    return f"user:{user_id}:identity:{version}"
+
+
+def load_identity(user_id, version):
+    """
+    Reads the identity of a user from the database and caches it under the version read
+    before, so a change committed meanwhile is never cached. Returns None if there's no such user.
+    """
+    row = User.objects.filter(pk=user_id).values(*IDENTITY_FIELDS, 'password').first()
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    _stats.flush_into(pipe, settings.IDENTITY_STATS_FLUSH_EVERY)
+    if row is not None:
+        # Only a digest of the hash is kept, for tokens carrying a revoke claim
+        row['revoke_hash'] = get_md5_hash_password(row.pop('password'))
+        pipe.set(identity_key(user_id, version), json.dumps(row), ex=settings.IDENTITY_CACHE_TTL)
+    pipe.execute()
+    _stats.count("db_loads")
+    return row
+
+
+def _remember(key, data):
+    if data is not None:
+        with _local_lock:
+            _local[key] = data
+    return data
+
+
+def _local_identity(key):
+    with _local_lock:
+        return _local.get(key)
+
+
+def fetch_identity(user_id):
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    pipe.get(version_key(user_id))
+    _stats.flush_into(pipe, settings.IDENTITY_STATS_FLUSH_EVERY)
+    version = int(pipe.execute()[0] or 0)
+    _stats.count("lookups")
+
+    data = _local_identity((user_id, version))
+    if data is not None:
+        return data
+    raw = get_redis_connection("default").get(identity_key(user_id, version))
+    data = json.loads(raw) if raw else load_identity(user_id, version)
+    return _remember((user_id, version), data)
+
+
+async def afetch_identity(user_id):
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.get(version_key(user_id))
+        _stats.flush_into(pipe, settings.IDENTITY_STATS_FLUSH_EVERY)
+        version = int((await pipe.execute())[0] or 0)
+    _stats.count("lookups")
+
+    data = _local_identity((user_id, version))
+    if data is not None:
+        return data
+    raw = await get_async_redis().get(identity_key(user_id, version))
+    data = json.loads(raw) if raw else await database_sync_to_async(load_identity)(user_id, version)
+    return _remember((user_id, version), data)
+
+
+def invalidate_identity(user_id):
+    # Entries of older versions are never read again and expire on their own
+    get_redis_connection("default").incr(version_key(user_id))
+
+
+def identity_stats():
+    # Counts of all processes since the counters were last reset, see the cache_stats command
+    stats = _stats.totals()
+    lookups = stats.get("lookups", 0)
+    db_loads = stats.get("db_loads", 0)
+    return {
+        "lookups": lookups,
+        "db_loads": db_loads,
+        "saved_queries": lookups - db_loads,
+        # Every lookup authenticates one request or socket
+        "saved_per_request": (lookups - db_loads) / lookups if lookups else None,
+    }
+
+
+def reset_identity_stats():
+    _stats.reset()
+
+
+def build_user(data):
+    # A user instance with the cached columns loaded and the others deferred
+    field_names = [field.attname for field in User._meta.concrete_fields if field.attname in IDENTITY_FIELDS]
+    return User.from_db('default', field_names, [data[name] for name in field_names])
+
+
+def check_identity(validated_token, data):
+    """Applies simplejwt's user checks to a cached identity and returns the user."""
+    if data is None:
+        raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+    if api_settings.CHECK_USER_IS_ACTIVE and not data['is_active']:
+        raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+    if api_settings.CHECK_REVOKE_TOKEN:
+        if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != data['revoke_hash']:
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+    return build_user(data)
+
+
+def token_user_id(validated_token):
+    try:
+        return validated_token[api_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken(_("Token contained no recognizable user identification"))
+
+
+def get_token_user(validated_token):
+    """Cached equivalent of JWTAuthentication.get_user."""
+    return check_identity(validated_token, fetch_identity(token_user_id(validated_token)))
+
+
+async def aget_token_user(validated_token):
+    return check_identity(validated_token, await afetch_identity(token_user_id(validated_token)))
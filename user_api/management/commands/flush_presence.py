@@ -0,0 +1,26 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from user_api.presence import flush_last_seen
+
+
+class Command(BaseCommand):
+    help = "Writes last seen times recorded in redis to the users table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true',
+            help="Keep flushing every PRESENCE_FLUSH_INTERVAL seconds instead of once.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.PRESENCE_FLUSH_BATCH_SIZE,
+            help="Users written per UPDATE statement.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = flush_last_seen(options['batch_size'])
+            self.stdout.write(f"Flushed last seen for {flushed} users")
+            if not options['loop']:
+                return
+            time.sleep(settings.PRESENCE_FLUSH_INTERVAL)
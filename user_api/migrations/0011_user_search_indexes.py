@@ -0,0 +1,44 @@
+from django.db import migrations
+
+# Indexes for the user directory search, see user_api/search.py.
+# PostgreSQL gets trigram indexes matching the UPPER(...) LIKE that Django
+# emits for icontains/istartswith, so any substring can use them. The SQLite
+# NOCASE indexes only serve prefix matches and are dropped again by 0012.
+
+SEARCH_FIELDS = ['username', 'first_name', 'last_name']
+
+POSTGRES_FORWARDS = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    f"CREATE INDEX user_api_user_{field}_trgm ON user_api_user USING GIN (UPPER({field}) gin_trgm_ops)"
+    for field in SEARCH_FIELDS
+]
+
+POSTGRES_BACKWARDS = [f"DROP INDEX IF EXISTS user_api_user_{field}_trgm" for field in SEARCH_FIELDS]
+
+SQLITE_FORWARDS = [
+    f"CREATE INDEX user_api_user_{field}_nocase ON user_api_user ({field} COLLATE NOCASE)"
+    for field in SEARCH_FIELDS
+]
+
+SQLITE_BACKWARDS = [f"DROP INDEX IF EXISTS user_api_user_{field}_nocase" for field in SEARCH_FIELDS]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_api', '0010_alter_user_profile_pic'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARDS, SQLITE_FORWARDS),
+            run_for_vendor(POSTGRES_BACKWARDS, SQLITE_BACKWARDS),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from importlib import import_module
+from django.db import migrations
+
+# The directory search matches substrings, which Django runs as LIKE '%term%'.
+# SQLite can't use an index for that, so the NOCASE indexes of 0011 were never
+# used by the search and only cost writes: SQLite has no substring search
+# acceleration and scans the users table. PostgreSQL keeps its trigram indexes.
+
+search_indexes = import_module('user_api.migrations.0011_user_search_indexes')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_api', '0011_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            search_indexes.run_for_vendor([], search_indexes.SQLITE_BACKWARDS),
+            search_indexes.run_for_vendor([], search_indexes.SQLITE_FORWARDS),
+        ),
+    ]
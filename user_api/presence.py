@@ -0,0 +1,154 @@
+import datetime
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Case, DateTimeField, Value, When
+from django_redis import get_redis_connection
+from Django_Chat.redis_client import get_async_redis
+from Django_Chat.serializers import PrefetchListSerializer
+
+User = get_user_model()
+
+# Online flag and last seen time of a user as stored in redis
+Presence = namedtuple("Presence", ["online", "last_seen"])
+
+OFFLINE = Presence(online=False, last_seen=None)
+
+# Presence is tracked per connection: every open socket is a member of the
+# user's connections sorted set, scored with the time its heartbeat expires.
+# A user is online while at least one member has not expired, so closing one
+# of several tabs keeps the user online and connections of a crashed worker
+# simply age out.
+#
+# Last seen times are only written to redis. Disconnects mark the user dirty
+# and flush_last_seen, run by the flush_presence command, writes the dirty
+# users to the users table in bulk, so reconnect storms cost the database one
+# statement per batch and flush instead of a write per socket.
+
+# Users whose last seen time changed since the last flush
+DIRTY_KEY = "presence:dirty"
+
+
+def connections_key(user_id):
+    return f"user:{user_id}:connections"
+
+
+def last_seen_key(user_id):
+    return f"user:{user_id}:last_seen"
+
+
+def fetch_presence(user_ids):
+    """Resolves presence for many users in a single pipelined round trip."""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+
+    now = time.time()
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zcount(connections_key(user_id), now, "+inf")
+    pipe.mget([last_seen_key(user_id) for user_id in user_ids])
+    *live_connections, last_seen_values = pipe.execute()
+
+    presence = {}
+    for user_id, live, last_seen in zip(user_ids, live_connections, last_seen_values):
+        presence[user_id] = Presence(
+            online=live > 0,
+            last_seen=datetime.datetime.fromisoformat(last_seen.decode()) if last_seen else None,
+        )
+    return presence
+
+
+async def heartbeat(user_id, connection_id):
+    """Registers or refreshes a connection and drops the user's expired ones."""
+    now = time.time()
+    key = connections_key(user_id)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.zadd(key, {connection_id: now + settings.PRESENCE_TTL})
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.expire(key, settings.PRESENCE_TTL)
+        await pipe.execute()
+
+
+async def disconnect(user_id, connection_id, last_seen):
+    # All writes go out in one pipelined round trip
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.zrem(connections_key(user_id), connection_id)
+        pipe.set(last_seen_key(user_id), last_seen.isoformat())
+        pipe.sadd(DIRTY_KEY, user_id)
+        await pipe.execute()
+
+
+def flush_last_seen(batch_size=None):
+    """
+    Writes the last seen times of the dirty users to the users table, one UPDATE
+    per batch. Returns the number of users written.
+    """
+    batch_size = batch_size or settings.PRESENCE_FLUSH_BATCH_SIZE
+    redis = get_redis_connection("default")
+    flushed = 0
+    while True:
+        # SPOP hands every dirty user to exactly one flusher
+        user_ids = [int(user_id) for user_id in redis.spop(DIRTY_KEY, batch_size)]
+        if not user_ids:
+            return flushed
+
+        values = redis.mget([last_seen_key(user_id) for user_id in user_ids])
+        last_seen = {
+            user_id: datetime.datetime.fromisoformat(value.decode())
+            for user_id, value in zip(user_ids, values) if value
+        }
+        try:
+            if last_seen:
+                User.objects.filter(id__in=last_seen).update(last_seen=Case(
+                    *[When(id=user_id, then=Value(seen)) for user_id, seen in last_seen.items()],
+                    output_field=DateTimeField(),
+                ))
+        except Exception:
+            # Mark the batch dirty again so the next flush retries it
+            redis.sadd(DIRTY_KEY, *user_ids)
+            raise
+        flushed += len(last_seen)
+
+        if len(user_ids) < batch_size:
+            return flushed
+
+
+def _presence_cache(context):
+    # Memoize on the request so every serializer in the same request shares lookups
+    request = context.get("request")
+    holder = request if request is not None else context
+    if isinstance(holder, dict):
+        return holder.setdefault("_presence_cache", {})
+    if not hasattr(holder, "_presence_cache"):
+        holder._presence_cache = {}
+    return holder._presence_cache
+
+
+def prefetch_presence(context, user_ids):
+    """Loads presence for the given users into the request cache, skipping known ones."""
+    cache = _presence_cache(context)
+    missing = [user_id for user_id in user_ids if user_id not in cache]
+    if missing:
+        cache.update(fetch_presence(missing))
+    return cache
+
+
+def get_presence(context, user_id):
+    return prefetch_presence(context, [user_id]).get(user_id, OFFLINE)
+
+
+# List serializer that resolves presence for the whole page before rendering rows
+class PresenceListSerializer(PrefetchListSerializer):
+    def prefetch(self, objects):
+        prefetch_presence(self.context, [obj.id for obj in objects])
+
+
+# Adds online_status/last_seen method fields backed by the batched lookup
+class PresenceFieldsMixin:
+    def get_online_status(self, obj) -> bool:
+        return get_presence(self.context, obj.id).online
+
+    def get_last_seen(self, obj) -> str:
+        return get_presence(self.context, obj.id).last_seen
@@ -0,0 +1,85 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Q, Value, When
+from rest_framework.filters import BaseFilterBackend
+from chat_room.pagination import KeysetCursorPagination
+
+# User directory search: every word of the query has to appear in the
+# username, first or last name. On PostgreSQL the trigram indexes of migration
+# 0011 serve the substring matches, SQLite scans the users table.
+# Matches are ranked prefix first, usernames before names.
+
+SEARCH_FIELDS = ('username', 'first_name', 'last_name')
+
+
+def search_users(queryset, query):
+    """Filters users matching every word of the query and annotates `match_rank` (lower is better)."""
+    terms = query.split()
+    for term in terms:
+        queryset = queryset.filter(
+            Q(username__icontains=term) | Q(first_name__icontains=term) | Q(last_name__icontains=term)
+        )
+
+    first = terms[0] if terms else ""
+    return queryset.annotate(match_rank=Case(
+        When(username__iexact=first, then=Value(0)),
+        When(username__istartswith=first, then=Value(1)),
+        When(Q(first_name__istartswith=first) | Q(last_name__istartswith=first), then=Value(2)),
+        default=Value(3),
+        output_field=IntegerField(),
+    ))
+
+
+def cache_key(query):
+    return "user_search:" + hashlib.md5(" ".join(query.lower().split()).encode()).hexdigest()
+
+
+# Replaces SearchFilter on the user directory. The first page of a search is
+# the same for everyone, so its ids are cached for a few seconds and popular
+# prefixes typed by many users at once hit the database only once.
+class UserSearchFilter(BaseFilterBackend):
+    search_param = "search"
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "").strip()
+        if not query:
+            return queryset
+
+        queryset = search_users(queryset, query)
+        paginator = getattr(view, "paginator", None)
+        if not settings.USER_SEARCH_CACHE_TTL or paginator is None \
+                or paginator.cursor_query_param in request.query_params:
+            return queryset
+
+        key = cache_key(query)
+        ids = cache.get(key)
+        if ids is None:
+            # One row more than a page so the paginator still knows whether there's a next one
+            ids = list(
+                queryset.order_by(*UserDirectoryPagination.search_ordering)
+                .values_list("id", flat=True)[:paginator.page_size + 1]
+            )
+            cache.set(key, ids, settings.USER_SEARCH_CACHE_TTL)
+        return queryset.filter(id__in=ids)
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            "name": self.search_param,
+            "required": False,
+            "in": "query",
+            "description": "Words the username, first or last name have to contain.",
+            "schema": {"type": "string"},
+        }]
+
+
+# Keyset pagination for the directory, search results are ordered by rank
+class UserDirectoryPagination(KeysetCursorPagination):
+    page_size = 35
+    ordering = ('username',)
+    search_ordering = ('match_rank', 'username', 'id')
+
+    def get_ordering(self, request, queryset, view):
+        if 'match_rank' in queryset.query.annotations:
+            return self.search_ordering
+        return super().get_ordering(request, queryset, view)
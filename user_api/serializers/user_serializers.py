@@ -2,10 +2,12 @@ from ..models import User, FriendRequest
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import authenticate
-from django_redis import get_redis_connection
+from django.db.models import Q
+from Django_Chat.serializers import PrefetchListSerializer
+from ..presence import PresenceFieldsMixin, PresenceListSerializer
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(PresenceFieldsMixin, serializers.ModelSerializer):
     online_status = serializers.SerializerMethodField()
     last_seen = serializers.SerializerMethodField()
     bio = serializers.CharField()
@@ -17,19 +19,7 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username','bio', 'email', 'full_name', 'friends', 'profile_pic','online_status', 'last_seen']
         read_only_fields = ['id', 'username', 'email']
-    
-    def get_online_status(self, obj) -> bool:
-        conn = get_redis_connection("default")
-        return conn.get(f"user:{obj.id}:online") == b"1"
-    
-
-    def get_last_seen(self, obj) -> str:
-        conn = get_redis_connection("default")
-        last_seen = conn.get(f"user:{obj.id}:last_seen")
-        if last_seen:
-            import datetime
-            return datetime.datetime.fromisoformat(last_seen.decode())
-        return None
+        list_serializer_class = PresenceListSerializer
 
     def get_full_name(self, obj) -> str:
         if obj.first_name or obj.last_name:
@@ -131,6 +121,34 @@ class UserProfileUpdateSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
     
+def prefetch_friend_requests(context, user_ids):
+    """
+    Loads the requesting user's friend requests with the given users, both
+    directions in one query, into a {user_id: (outgoing, incoming)} map memoized in the context.
+    """
+    requests = context.setdefault('friend_requests', {})
+    me = context['request'].user
+    missing = [user_id for user_id in user_ids if user_id not in requests]
+    if missing:
+        found = {user_id: [None, None] for user_id in missing}
+        rows = FriendRequest.objects.filter(
+            Q(from_user=me, to_user_id__in=missing) | Q(to_user=me, from_user_id__in=missing)
+        ).only('id', 'from_user_id', 'to_user_id', 'status')
+        for friend_request in rows:
+            if friend_request.from_user_id == me.id:
+                found[friend_request.to_user_id][0] = friend_request
+            else:
+                found[friend_request.from_user_id][1] = friend_request
+        requests.update((user_id, tuple(pair)) for user_id, pair in found.items())
+    return requests
+
+
+# Resolves the friend requests of the whole page before rendering rows
+class FriendshipListSerializer(PrefetchListSerializer):
+    def prefetch(self, objects):
+        prefetch_friend_requests(self.context, [obj.id for obj in objects])
+
+
 class ListUserSerializer(serializers.ModelSerializer):
     bio = serializers.CharField()
     friends = serializers.PrimaryKeyRelatedField(
@@ -146,7 +164,12 @@ class ListUserSerializer(serializers.ModelSerializer):
                   'profile_pic', 'friendship_status','outgoing_request_id',
                   'incoming_request_id'
         ]
+        list_serializer_class = FriendshipListSerializer
     
+    def get_friend_requests(self, user):
+        # (outgoing, incoming) friend request between the requesting user and this one
+        return prefetch_friend_requests(self.context, [user.id])[user.id]
+
     def get_friendship_status(self, other_user):
         request_user = self.context['request'].user
         
@@ -154,34 +177,20 @@ class ListUserSerializer(serializers.ModelSerializer):
         if request_user == other_user:
             return None
         
-        try:
-            fr = FriendRequest.objects.get(from_user=request_user, to_user=other_user)
+        for fr, pending_status in zip(self.get_friend_requests(other_user), ('request_sent', 'request_received')):
+            if fr is None:
+                continue
             if fr.status == 'pending':
-                return 'request_sent'
+                return pending_status
             elif fr.status == 'accepted':
                 return 'friends'
         
-        except FriendRequest.DoesNotExist:
-            pass
-        
-        try:
-            fr = FriendRequest.objects.get(from_user=other_user, to_user=request_user)
-            if fr.status == 'pending':
-                return 'request_received'
-            elif fr.status == 'accepted':
-                return 'friends'
-        
-        except FriendRequest.DoesNotExist:
-            pass
-        
         return None
 
     def get_outgoing_request_id(self, user):
-        me = self.context["request"].user
-        fr = FriendRequest.objects.filter(from_user=me, to_user=user).first()
+        fr = self.get_friend_requests(user)[0]
         return fr.id if fr else None
 
     def get_incoming_request_id(self, user):
-        me = self.context["request"].user
-        fr = FriendRequest.objects.filter(from_user=user, to_user=me).first()
-        return fr.id if fr else None
\ No newline at end of file
+        fr = self.get_friend_requests(user)[1]
+        return fr.id if fr else None
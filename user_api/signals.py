@@ -0,0 +1,13 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .identity import invalidate_identity
+from .models import User
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_identity(sender, instance, **kwargs):
+    """Drops the cached identity once a saved or deleted user is committed."""
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_identity(user_id))
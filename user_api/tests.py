@@ -1,3 +1,172 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from Django_Chat.testing import FakeRedisMixin, make_user
+from . import identity, presence
+from .models import FriendRequest
+from .search import UserDirectoryPagination, cache_key
 
-# Create your tests here.
+
+# The user directory renders a page in a fixed number of queries
+class UserDirectoryQueryCountTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for i in range(40):
+            other = make_user(f"member{i:02}")
+            other.friends.add(make_user(f"pal{i:02}"))
+            if i % 4 == 0:
+                FriendRequest.objects.create(from_user=self.user, to_user=other)
+            elif i % 4 == 1:
+                FriendRequest.objects.create(from_user=other, to_user=self.user)
+            elif i % 4 == 2:
+                FriendRequest.objects.create(from_user=self.user, to_user=other, status='accepted')
+                self.user.friends.add(other)
+
+    def assert_directory_queries(self, page_size):
+        with mock.patch.object(UserDirectoryPagination, "page_size", page_size):
+            # The users, their friend ids, then the friend requests with the requesting user
+            with self.assertNumQueries(3):
+                response = self.client.get("/api/users/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), page_size)
+        return {row["username"]: row for row in response.data["results"]}
+
+    def test_query_count_is_independent_of_page_size(self):
+        for page_size in (5, 35):
+            with self.subTest(page_size=page_size):
+                self.assert_directory_queries(page_size)
+
+    def test_friendship_relations(self):
+        # Usernames sort the requesting user first, then member00 to member03
+        rows = self.assert_directory_queries(5)
+        self.assertEqual(
+            [(row["friendship_status"], bool(row["outgoing_request_id"]), bool(row["incoming_request_id"]))
+             for row in rows.values()],
+            [(None, False, False), ('request_sent', True, False), ('request_received', False, True),
+             ('friends', True, False), (None, False, False)],
+        )
+        self.assertEqual(len(rows["member00"]["friends"]), 1)
+        self.assertEqual(len(rows["me"]["friends"]), 10)
+
+
+# Directory search ranks prefix matches first and caches the ids of first pages
+class UserDirectorySearchTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("me")
+        for username in ("joann", "annabel", "ann", "hannah"):
+            make_user(username)
+        named = make_user("bob")
+        named.first_name = "Anna"
+        named.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, query):
+        response = self.client.get("/api/users/", {"search": query})
+        self.assertEqual(response.status_code, 200)
+        return [row["username"] for row in response.data["results"]]
+
+    def test_prefix_matches_rank_first(self):
+        # The exact username, username prefixes, name prefixes, then the rest by username
+        self.assertEqual(self.search("ann"), ["ann", "annabel", "bob", "hannah", "joann"])
+
+    def test_first_page_ids_are_cached(self):
+        # The ids of the page, then the users, their friends and the friend requests
+        with self.assertNumQueries(4):
+            first = self.search("ann")
+        self.assertEqual(len(cache.get(cache_key("ann"))), 5)
+
+        make_user("anna")
+        # The same query in other spelling is served from the cached ids until they expire
+        with self.assertNumQueries(3):
+            self.assertEqual(self.search("  ANN "), first)
+        with override_settings(USER_SEARCH_CACHE_TTL=0):
+            self.assertIn("anna", self.search("ann"))
+
+    def test_cursor_pages_follow_the_ranking(self):
+        expected = self.search("ann")
+        pages = []
+        with mock.patch.object(UserDirectoryPagination, "page_size", 2):
+            url = "/api/users/?search=ann"
+            while url:
+                response = self.client.get(url)
+                pages.append([row["username"] for row in response.data["results"]])
+                url = response.data["next"]
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([username for page in pages for username in page], expected)
+
+
+# Identity cache counts are kept in the process and added to redis in batches
+@override_settings(IDENTITY_STATS_FLUSH_EVERY=2)
+class IdentityStatsTests(FakeRedisMixin, TestCase):
+
+    def test_counts_are_flushed_in_batches(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(make_user('me'))}")
+        for requests in (1, 2, 3, 4):
+            self.assertEqual(client.get("/api/users/").status_code, 200)
+            if requests == 1:
+                # Nothing is written until the batch is full
+                self.assertEqual(identity.identity_stats()["lookups"], 0)
+
+        # The counts go out on the next lookup's pipeline, the fourth lookup is still in the process
+        self.assertEqual(identity.identity_stats(), {
+            "lookups": 3, "db_loads": 1, "saved_queries": 2, "saved_per_request": 2 / 3,
+        })
+        out = StringIO()
+        call_command("cache_stats", "--reset", stdout=out)
+        self.assertIn("Identity cache: 3 lookups, 1 database loads, 2 queries saved, 66.7% of requests", out.getvalue())
+        self.assertEqual(identity.identity_stats()["lookups"], 0)
+
+
+# Last seen times go to redis on disconnect and reach the users table in batches
+class PresenceFlushTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = [make_user(f"user{i}") for i in range(5)]
+        self.seen = {}
+        for i, user in enumerate(self.users):
+            self.seen[user.id] = timezone.now() - timedelta(minutes=i)
+            async_to_sync(presence.disconnect)(user.id, f"socket.{i}", self.seen[user.id])
+
+    def dirty(self):
+        return {int(user_id) for user_id in get_redis_connection("default").smembers(presence.DIRTY_KEY)}
+
+    def test_flush_writes_one_update_per_batch(self):
+        # Batches of 2, 2 and 1, the short one ends the flush
+        with self.assertNumQueries(3):
+            self.assertEqual(presence.flush_last_seen(batch_size=2), 5)
+        for user in self.users:
+            user.refresh_from_db()
+            self.assertEqual(user.last_seen, self.seen[user.id])
+        self.assertEqual(self.dirty(), set())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(presence.flush_last_seen(batch_size=2), 0)
+
+    def test_failed_batch_is_marked_dirty_again(self):
+        with mock.patch.object(QuerySet, "update", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                presence.flush_last_seen(batch_size=2)
+        # The failed batch went back, the rest was never popped
+        self.assertEqual(self.dirty(), {user.id for user in self.users})
+
+        self.assertEqual(presence.flush_last_seen(batch_size=2), 5)
+        self.assertEqual(self.dirty(), set())
@@ -9,9 +9,8 @@ from ..models import FriendRequest, User
 from ..serializers import FriendRequestSerializer, UserSerializer
 from chat_room.models import ChatRoom
 from chat_room.serializers import ChatRoomSerializer
+from chat_room.sidebar import broadcast_sidebar_update
 import json
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from django.core.serializers.json import DjangoJSONEncoder
 
 
@@ -125,7 +124,6 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
                     room_name=f"{request.user.username}_{friend_request.from_user.username}"
                 )
                 chat_room.participants.set([request.user, friend_request.from_user])
-                channel_layer = get_channel_layer()
                 serialized_data = ChatRoomSerializer(
                     chat_room, 
                     context=self.get_serializer_context()
@@ -133,14 +131,11 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
                 json_data = json.dumps(serialized_data, cls=DjangoJSONEncoder)
                 safe_data = json.loads(json_data)
                 
-                async_to_sync(channel_layer.group_send)(
-                    "sidebar",
+                broadcast_sidebar_update(
+                    [request.user.id, friend_request.from_user.id],
                     {
-                        "type": "group.update",
-                        "data": {
-                            "type": "group_created",
-                            "group": safe_data
-                        }
+                        "type": "group_created",
+                        "group": safe_data
                     }
                 )
             return Response({"detail": "Friend request accepted."}, status=status.HTTP_200_OK)
@@ -215,7 +210,7 @@ class FriendModelViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
     
     def get_queryset(self):
-        queryset = self.request.user.friends.all()
+        queryset = self.request.user.friends.prefetch_related('friends')
         search = self.request.query_params.get("search")
         if search:
             queryset = queryset.filter(username__icontains=search)
@@ -5,7 +5,9 @@ from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework import status, generics, viewsets
 from ..models import User
-from rest_framework.filters import OrderingFilter, SearchFilter
+from django.db.models import Prefetch
+from rest_framework.filters import OrderingFilter
+from ..search import UserSearchFilter, UserDirectoryPagination
 
 
 def get_tokens_for_user(user):
@@ -81,8 +83,12 @@ class ListUserViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = ListUserSerializer
     queryset = User.objects.all()
-    filter_backends = {SearchFilter, OrderingFilter}
-    search_fields = ['username', 'first_name', 'last_name']
+    filter_backends = (UserSearchFilter, OrderingFilter)
     ordering_fields = ['username', 'first_name', 'last_name']
     ordering = ['username']
-    http_method_names = ['get']
\ No newline at end of file
+    pagination_class = UserDirectoryPagination
+    http_method_names = ['get']
+
+    def get_queryset(self):
+        # Friend ids for the whole page come from one prefetch query
+        return User.objects.prefetch_related(Prefetch('friends', queryset=User.objects.only('id')))
\ No newline at end of file